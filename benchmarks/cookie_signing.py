@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Measures signing and verifying cookie payloads with ``CookieStorage``,
+compared to building a new HMAC object (and comparing with ``!=``) each time,
+which is what ``CookieStorage`` did prior to precomputing the keyed HMAC.
+
+Usage::
+
+    python benchmarks/cookie_signing.py [iterations] [payload size]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+settings.configure(SECRET_KEY='benchmark' * 6)
+
+from formwizard.storage import CookieStorage
+import hashlib
+import hmac
+import timeit
+
+
+def old_hmac(storage, data):
+    key = b'%s$%s' % (settings.SECRET_KEY, storage.key)
+    return hmac.new(key, data.encode('utf-8'), hashlib.sha1).hexdigest()
+
+
+def main(iterations=100000, size=1000):
+    payload = '{"current_step":null,"steps":{"x":"%s"}}' % ('x' * size)
+    results = []
+    for digest in ('sha1', 'sha256', 'blake2b'):
+        if not hasattr(hashlib, digest):
+            continue
+        storage = type(str('Storage'), (CookieStorage, ),
+                       {'hmac_digest': digest})('name', 'namespace')
+        signed = storage.sign(payload)
+        signature, _, data = signed.partition('$')
+        results.append(('sign (%s)' % digest,
+                        lambda: storage.sign(payload)))
+        results.append(('verify (%s)' % digest,
+                        lambda: storage.verify(signature, data)))
+    storage = CookieStorage('name', 'namespace')
+    signature = old_hmac(storage, payload)
+    results.insert(0, ('sign (sha1, old)', lambda: old_hmac(storage, payload)))
+    results.insert(1, ('verify (sha1, old)',
+                       lambda: old_hmac(storage, payload) != signature))
+
+    print('%d iterations, %d byte payload' % (iterations, len(payload)))
+    for name, func in results:
+        elapsed = timeit.timeit(func, number=iterations)
+        print('  %-20s %8.2f us' % (name, elapsed * 1e6 / iterations))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
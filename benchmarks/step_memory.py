@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+"""
+Compares the memory used by wizard steps holding a ``QueryDict`` copied from
+``request.POST`` (the representation prior to ``StepData``), with the
+memory used by ``Step`` objects holding ``StepData``.
+
+Usage::
+
+    python benchmarks/step_memory.py [wizards] [steps] [fields]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+import os
+import sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from django.conf import settings
+settings.configure()
+
+from django.http import QueryDict
+from formwizard.storage import Step
+
+
+class OldStep(object):
+    def __init__(self, name, data=None, files=None, forms=None):
+        self.name = name
+        self.data = data
+        self.files = files
+        self.forms = forms
+
+
+def deep_size(obj, seen=None):
+    """
+    Returns the size of *obj* and everything it references, counting shared
+    objects once.
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(key, seen) + deep_size(value, seen)
+                    for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_size(obj.__dict__, seen)
+    for cls in type(obj).__mro__:
+        for slot in getattr(cls, '__slots__', ()):
+            if hasattr(obj, slot):
+                size += deep_size(getattr(obj, slot), seen)
+    return size
+
+
+def make_post(wizard, step, fields):
+    # Each request parses its own POST, so keys aren't shared between
+    # wizards unless they're interned.
+    query = '&'.join('form-0-field-%d=value-%d-%d' % (i, wizard, i)
+                     for i in range(fields))
+    return QueryDict(query.encode('ascii'))
+
+
+def main(wizards=1000, steps=5, fields=20):
+    old, new = [], []
+    for w in range(wizards):
+        old.append([OldStep('step %d' % s, data=make_post(w, s, fields).copy())
+                    for s in range(steps)])
+        new.append([Step('step %d' % s, data=make_post(w, s, fields))
+                    for s in range(steps)])
+    old_size, new_size = deep_size(old), deep_size(new)
+    print('%d wizards x %d steps x %d fields' % (wizards, steps, fields))
+    print('  Step + QueryDict: %10d bytes' % old_size)
+    print('  Step + StepData:  %10d bytes (%.0f%%)'
+          % (new_size, 100.0 * new_size / old_size))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,42 @@
+from __future__ import absolute_import, unicode_literals
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import NoArgsCommand
+from formwizard.models import WizardFile
+from optparse import make_option
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes files stored by wizards that haven\'t been used for a '
+            'while (only files tracked in WizardFile are considered). '
+            'Files are marked as used whenever a state referencing them is '
+            'written, so --ttl should be at least the --ttl of '
+            'clearwizardstates (or the lifetime of sessions, for wizards '
+            'that store their state in the session).')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--ttl', type='int', dest='ttl', default=None,
+                    help='Number of seconds after which unused files are '
+                         'deleted. Defaults to SESSION_COOKIE_AGE.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of files to delete per batch.'),
+        make_option('--file-storage', dest='file_storage', default=None,
+                    help='Import path of the file storage class the wizards '
+                         'use. Defaults to DEFAULT_FILE_STORAGE.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['file_storage']:
+            file_storage = get_storage_class(options['file_storage'])()
+        else:
+            file_storage = default_storage
+        ttl = options['ttl']
+        if ttl is None:
+            ttl = settings.SESSION_COOKIE_AGE
+        deleted = WizardFile.objects.clear_stale(
+                file_storage, timedelta(seconds=ttl),
+                batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('Deleted %d file(s)\n' % deleted)
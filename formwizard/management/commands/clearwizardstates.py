@@ -0,0 +1,56 @@
+from __future__ import absolute_import, unicode_literals
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage, get_storage_class
+from django.core.management.base import CommandError, NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.importlib import import_module
+from formwizard.models import WizardState
+from optparse import make_option
+
+
+class Command(NoArgsCommand):
+    help = ('Deletes the states of DatabaseStorage wizards that haven\'t '
+            'been used for a while, along with their files.')
+
+    option_list = NoArgsCommand.option_list + (
+        make_option('--ttl', type='int', dest='ttl', default=None,
+                    help='Number of seconds after which unused states are '
+                         'deleted. Defaults to SESSION_COOKIE_AGE.'),
+        make_option('--orphaned', action='store_true', dest='orphaned',
+                    default=False,
+                    help='Also delete the states of anonymous users whose '
+                         'session no longer exists.'),
+        make_option('--batch-size', type='int', dest='batch_size',
+                    default=1000,
+                    help='Number of states to delete per batch.'),
+        make_option('--file-storage', dest='file_storage', default=None,
+                    help='Import path of the file storage class the wizards '
+                         'use. Defaults to DEFAULT_FILE_STORAGE.'),
+        make_option('--database', dest='database', default=DEFAULT_DB_ALIAS,
+                    help='The database that holds the states. Defaults to '
+                         'the "default" database.'),
+    )
+
+    def handle_noargs(self, **options):
+        if options['file_storage']:
+            file_storage = get_storage_class(options['file_storage'])()
+        else:
+            file_storage = default_storage
+        ttl = options['ttl']
+        if ttl is None:
+            ttl = settings.SESSION_COOKIE_AGE
+        states = WizardState.objects.db_manager(options['database'])
+        deleted = states.clear_expired(
+                timedelta(seconds=ttl), file_storage,
+                batch_size=options['batch_size'])
+        if options['orphaned']:
+            if settings.SESSION_ENGINE.endswith('.signed_cookies'):
+                raise CommandError('Orphaned states can\'t be determined '
+                                   'with cookie based sessions.')
+            engine = import_module(settings.SESSION_ENGINE)
+            deleted += states.clear_orphaned(
+                    engine.SessionStore().exists, file_storage,
+                    batch_size=options['batch_size'])
+        if int(options.get('verbosity', 1)) >= 1:
+            self.stdout.write('Deleted %d state(s)\n' % deleted)
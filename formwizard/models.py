@@ -1,6 +1,7 @@
 from __future__ import absolute_import, unicode_literals
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 try:
     from django.utils.timezone import now
 except ImportError:
@@ -8,6 +9,109 @@ except ImportError:
     now = datetime.now
 
 
+def _file_keys(data):
+    """
+    Returns the keys of the files referenced by *data*, a serialized state or
+    step.
+    """
+    from formwizard.storage import serializers
+    try:
+        data = serializers.loads(data)
+    except ValueError:
+        return []
+    if 'steps' not in data:
+        steps = [data]
+    elif isinstance(data['steps'], dict):
+        steps = data['steps'].itervalues()
+    else:
+        steps = []  # stored in ``WizardStepState`` rows
+    return [attrs['file_storage_key'] for step in steps
+            for attrs in (step['files'] or {}).itervalues()]
+
+
+class WizardStateManager(models.Manager):
+    def clear_expired(self, ttl, file_storage=None, batch_size=1000):
+        """
+        Deletes the states that haven't been written for *ttl* (a
+        ``timedelta``) in batches of *batch_size*, see ``delete_states()``.
+
+        :returns: the number of states deleted
+        """
+        cutoff = now() - ttl
+        deleted = 0
+        while True:
+            batch = list(self.filter(modified_at__lt=cutoff)
+                             .order_by('pk')
+                             .values_list('pk', flat=True)[:batch_size])
+            if not batch:
+                return deleted
+            # states that are written in the meantime are kept
+            deleted += self.delete_states(batch, file_storage,
+                                          modified_before=cutoff)
+
+    def clear_orphaned(self, session_exists, file_storage=None,
+                       batch_size=1000):
+        """
+        Deletes the states of anonymous users whose session no longer exists
+        in batches of *batch_size*, see ``delete_states()``.
+
+        :param session_exists: callable that's given a session key, and
+                               returns whether the session exists
+        :returns: the number of states deleted
+        """
+        deleted = 0
+        last = 0
+        while True:
+            batch = list(self.filter(user__isnull=True, pk__gt=last)
+                             .order_by('pk')
+                             .values_list('pk', 'session_key')[:batch_size])
+            if not batch:
+                return deleted
+            last = batch[-1][0]
+            deleted += self.delete_states([pk for pk, key in batch
+                                           if not session_exists(key)],
+                                          file_storage)
+
+    def delete_states(self, pks, file_storage=None, modified_before=None):
+        """
+        Deletes the states with the primary keys *pks* (that haven't been
+        written since *modified_before*, if given), along with the files they
+        reference from *file_storage* (if given). Files that are tracked in
+        ``WizardFile`` may be shared, they're released instead and left to
+        ``WizardFileManager.clear_stale()``.
+
+        The states are locked while they're deleted, so that a state that's
+        written concurrently either isn't deleted, or is created anew.
+
+        :returns: the number of states deleted
+        """
+        if not pks:
+            return 0
+        keys, tracked = set(), set()
+        with transaction.atomic(using=self.db):
+            states = self.select_for_update().filter(pk__in=pks)
+            if modified_before is not None:
+                states = states.filter(modified_at__lt=modified_before)
+            rows = list(states.values_list('pk', 'data'))
+            pks = [pk for pk, data in rows]
+            if pks and file_storage is not None:
+                for pk, data in rows:
+                    keys.update(_file_keys(data))
+                for data in (WizardStepState.objects.using(self.db)
+                                                    .filter(state__in=pks)
+                                                    .values_list('data',
+                                                                 flat=True)):
+                    keys.update(_file_keys(data))
+                tracked = set(WizardFile.objects.filter(key__in=keys)
+                                                .values_list('key', flat=True))
+                WizardFile.objects.release(tracked)
+            self.filter(pk__in=pks).delete()
+        # files are only deleted once the states are gone for good
+        for key in keys - tracked:
+            file_storage.delete(key)
+        return len(pks)
+
+
 class WizardState(models.Model):
     """
     This model provides the backend for the ``DatabaseStorage`` storage.
@@ -15,14 +119,21 @@ class WizardState(models.Model):
     As wizard prefixes are only unique within the context of a single user,
     either ``session_key`` or ``user`` must be provided. This is enforced via
     ``clean``, so be sure to call ``full_clean`` prior to saving.
+
+    ``version`` is incremented on each write, so that concurrent writes can
+    be detected. States that haven't been written for a while are deleted by
+    the ``clearwizardstates`` management command.
     """
     name = models.CharField(max_length=200)
     namespace = models.CharField(max_length=200)
     session_key = models.CharField(max_length=40, blank=True)
     user = models.ForeignKey('auth.User', blank=True, null=True)
     data = models.TextField(default='{"current_step":null,"steps":{}}')
+    version = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(default=now)
-    modified_at = models.DateTimeField(auto_now=True)
+    modified_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = WizardStateManager()
 
     class Meta:
         unique_together = ('name', 'namespace', 'session_key', 'user')
@@ -31,3 +142,91 @@ class WizardState(models.Model):
         if not (self.session_key or self.user):
             raise ValidationError('Either `session_key` or `user` must be '
                                   'provided.')
+
+
+class WizardStepState(models.Model):
+    """
+    A step of a state stored by ``PerStepDatabaseStorage``, which stores each
+    step in a row of its own. The ``WizardState`` row then only holds the
+    current step and the names of the steps.
+    """
+    state = models.ForeignKey(WizardState, related_name='step_states')
+    name = models.CharField(max_length=200)
+    data = models.TextField()
+
+    class Meta:
+        unique_together = ('state', 'name')
+
+
+class WizardFileManager(models.Manager):
+    def acquire(self, keys):
+        """
+        Increments the reference count of the files with the given *keys*.
+        """
+        if keys:
+            self.filter(key__in=keys).update(refcount=F('refcount') + 1)
+
+    def release(self, keys):
+        """
+        Decrements the reference count of the files with the given *keys*.
+        """
+        if keys:
+            self.filter(key__in=keys, refcount__gt=0) \
+                .update(refcount=F('refcount') - 1, modified_at=now())
+
+    def touch(self, keys):
+        """
+        Marks the files with the given *keys* as still in use.
+        """
+        if keys:
+            self.filter(key__in=keys).update(modified_at=now())
+
+    def clear_stale(self, file_storage, ttl, batch_size=1000):
+        """
+        Deletes the files that haven't been used for *ttl* (a ``timedelta``)
+        from *file_storage*, along with their entries, in batches of
+        *batch_size*.
+
+        A file is only marked as used when a state referencing it is written,
+        so *ttl* must be at least as long as states are kept (see the
+        ``clearwizardstates`` management command), otherwise the files of
+        idle wizards are deleted while they're still referenced. Files are
+        deleted regardless of ``refcount``, as only the expiry of database
+        states releases references: the states of abandoned wizards that
+        are stored elsewhere (e.g. in sessions) just stop being written.
+
+        :returns: the number of files deleted
+        """
+        cutoff = now() - ttl
+        deleted = 0
+        while True:
+            batch = list(self.filter(modified_at__lt=cutoff)
+                             .order_by('pk')
+                             .values_list('pk', 'key')[:batch_size])
+            if not batch:
+                return deleted
+            for pk, key in batch:
+                file_storage.delete(key)
+            self.filter(pk__in=[pk for pk, key in batch]).delete()
+            deleted += len(batch)
+
+
+class WizardFile(models.Model):
+    """
+    An index of files stored by storages that deduplicate files globally
+    (``Storage.file_dedup = 'global'``) or track their files
+    (``Storage.track_files = True``).
+
+    It maps the digest of a file's content to its key in the file storage.
+    ``refcount`` is the number of wizard states referencing the file (when
+    deduplicating globally). ``modified_at`` is updated whenever a state
+    referencing the file is written, files that haven't been used for a
+    while are deleted by the ``clearwizardfiles`` management command.
+    """
+    key = models.CharField(max_length=255, unique=True)
+    digest = models.CharField(max_length=128, db_index=True)
+    refcount = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(default=now)
+    modified_at = models.DateTimeField(auto_now=True)
+
+    objects = WizardFileManager()
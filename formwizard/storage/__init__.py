@@ -1,13 +1,17 @@
 from __future__ import absolute_import, unicode_literals
 from django.utils.importlib import import_module
-from formwizard.storage.base import Storage, Step
-from formwizard.storage.cookie import CookieStorage
+from formwizard.storage.base import LazySteps, Storage, Step, StepData
+from formwizard.storage.cache import CacheStorage
+from formwizard.storage.cookie import CookieStorage, PerStepCookieStorage
 from formwizard.storage.dummy import DummyStorage
 from formwizard.storage.session import SessionStorage
-from formwizard.storage.db import DatabaseStorage
-from formwizard.storage.exceptions import (MissingStorageModule,
+from formwizard.storage.db import DatabaseStorage, PerStepDatabaseStorage
+from formwizard.storage.memory import MemoryStorage
+from formwizard.storage.exceptions import (FileNotSaved, FileTooLarge,
+                                           MissingStorageModule,
                                            MissingStorageClass,
-                                           NoFileStorageConfigured)
+                                           NoFileStorageConfigured,
+                                           StateConflict)
 
 
 def get_storage(path):
@@ -1,7 +1,153 @@
 from __future__ import absolute_import, unicode_literals
-from django.core.files.uploadedfile import UploadedFile
+from django.core.exceptions import ImproperlyConfigured
 from django.template.defaultfilters import slugify
-from formwizard.storage.exceptions import NoFileStorageConfigured
+from django.utils.datastructures import MultiValueDict
+from django.utils.encoding import smart_str
+from formwizard.storage.exceptions import (FileTooLarge,
+                                           NoFileStorageConfigured,
+                                           StateConflict)
+from formwizard.storage.files import (get_pool, LazyUploadedFile, save_async,
+                                      SizeBudget, StreamedFile)
+from formwizard.storage import serializers
+from formwizard.models import WizardFile
+from functools import partial
+import collections
+import hashlib
+import sys
+
+
+# Keys are interned so that steps of concurrent wizards share them. The table
+# is capped, as keys ultimately come from user input.
+_interned_keys = {}
+INTERNED_KEYS_LIMIT = 10000
+
+
+def _intern(key):
+    try:
+        return _interned_keys[key]
+    except KeyError:
+        if len(_interned_keys) < INTERNED_KEYS_LIMIT:
+            _interned_keys[key] = key
+        return key
+
+
+class StepData(object):
+    """
+    An immutable mapping of the raw form data for a step.
+
+    It behaves like a read-only ``QueryDict``: ``data[key]`` returns the last
+    value for *key* (``[]`` if it has none), and ``getlist(key)`` returns all
+    of them. Single values
+    are stored as-is, multiple values as a ``tuple``.
+
+    :param data: ``QueryDict``, ``MultiValueDict``, or a mapping whose values
+                 are either a single value or a ``list`` of values
+    """
+    __slots__ = ('_data', )
+
+    def __init__(self, data=()):
+        if hasattr(data, 'lists'):
+            items = data.lists()
+        elif hasattr(data, 'iteritems'):
+            items = data.iteritems()
+        else:
+            items = data
+        self._data = {}
+        for key, value in items:
+            if isinstance(value, (list, tuple)):
+                value = value[0] if len(value) == 1 else tuple(value)
+            self._data[_intern(key)] = value
+
+    def __reduce__(self):
+        return (StepData, (self.to_dict(), ))
+
+    def __repr__(self):
+        return '<%s: %r>' % (self.__class__.__name__, self.to_dict())
+
+    def __getitem__(self, key):
+        value = self._data[key]
+        if isinstance(value, tuple):
+            return value[-1] if value else []
+        return value
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, StepData):
+            return self._data == other._data
+        if not isinstance(other, collections.Mapping):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        try:
+            value = self[key]
+        except KeyError:
+            return default
+        return default if value == [] else value
+
+    def getlist(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            return [] if default is None else default
+        return list(value) if isinstance(value, tuple) else [value]
+
+    def keys(self):
+        return self._data.keys()
+
+    def iterkeys(self):
+        return iter(self._data)
+
+    def items(self):
+        return list(self.iteritems())
+
+    def iteritems(self):
+        for key in self._data:
+            yield key, self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def itervalues(self):
+        for key in self._data:
+            yield self[key]
+
+    def lists(self):
+        return [(key, self.getlist(key)) for key in self._data]
+
+    def copy(self):
+        return self  # immutable
+
+    def to_dict(self):
+        """
+        Returns a ``dict`` where keys with multiple values map to a ``list``,
+        suitable for passing back to the constructor.
+        """
+        return dict((key, list(value) if isinstance(value, tuple) else value)
+                    for key, value in self._data.iteritems())
+
+    def to_multivaluedict(self):
+        """
+        Returns a ``MultiValueDict`` of the data, as is needed by forms with
+        widgets that accept multiple values.
+        """
+        return MultiValueDict(self.lists())
+
+collections.Mapping.register(StepData)
 
 
 class Step(object):
@@ -10,24 +156,107 @@ class Step(object):
 
     :param  name: name of step
     :type   name: ``unicode``
-    :param  data: form data
+    :param  data: form data, stored as ``StepData``
     :type   data: ``{"<field name>": "<raw value>", ...}``
     :param files: form files
     :type  files: ``{"<field name>": <UploadedFile object>, ...}``
     :param forms: all the forms for the step
     :type  forms: iterable
+
+    Assigning to ``data`` or ``files`` flags the step as ``modified``, which
+    lets storages skip writing state that hasn't changed. Assigning data
+    that's equal to the existing data isn't considered a modification.
     """
+    __slots__ = ('name', '_data', '_files', 'forms', 'modified')
+
     def __init__(self, name, data=None, files=None, forms=None):
+        if data is not None and not isinstance(data, StepData):
+            data = StepData(data)
         self.name = name
-        self.data = data
-        self.files = files
+        self._data = data
+        self._files = files
         self.forms = forms
+        self.modified = False
+
+    @property
+    def data(self):
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        if value is not None and not isinstance(value, StepData):
+            value = StepData(value)
+        if value != self._data:
+            self._data = value
+            self.modified = True
+
+    @property
+    def files(self):
+        return self._files
+
+    @files.setter
+    def files(self, value):
+        self._files = value
+        self.modified = True
 
     @property
     def slug(self):
         return slugify(self.name)
 
 
+class LazySteps(collections.MutableMapping):
+    """
+    A ``dict``-like container of steps that defers decoding a step until it's
+    first accessed.
+
+    Steps that are never accessed remain in their encoded form in
+    ``pending``, so that they can be written back without being decoded and
+    re-encoded.
+
+    :param decode_step: callable that is given the step name and its encoded
+                        form, and returns a ``Step`` object
+    :param     pending: encoded steps ``{"<name>": {...}, ...}``
+    """
+    def __init__(self, decode_step, pending):
+        self._decode_step = decode_step
+        self._steps = {}
+        self.pending = dict(pending)
+
+    def __getitem__(self, name):
+        try:
+            return self._steps[name]
+        except KeyError:
+            attrs = self.pending.pop(name)
+            step = self._steps[name] = self._decode_step(name, attrs)
+            return step
+
+    def __setitem__(self, name, step):
+        self.pending.pop(name, None)
+        self._steps[name] = step
+
+    def __delitem__(self, name):
+        if name in self.pending:
+            del self.pending[name]
+        else:
+            del self._steps[name]
+
+    def __contains__(self, name):
+        return name in self._steps or name in self.pending
+
+    def __iter__(self):
+        # copied, as iterating over the values decodes pending steps
+        return iter(self._steps.keys() + self.pending.keys())
+
+    def __len__(self):
+        return len(self._steps) + len(self.pending)
+
+    def decoded(self):
+        """
+        Returns a ``list`` of the steps that have been decoded.
+        """
+        return self._steps.values()
+
+
 class Storage(object):
     """
     Base class for all wizard storages.
@@ -47,15 +276,125 @@ class Storage(object):
                          If omitted, this storage will refuse to store forms
                          that include file fields.
     :type  file_storage: ``django.core.files.Storage`` class
+
+    When ``lazy_decode`` is ``True``, ``decode()`` populates ``steps`` with a
+    ``LazySteps`` object, so that only the steps that are used during a
+    request are decoded.
+
+    Storages that need the state as text use ``serialize()`` and
+    ``deserialize()``, the format is determined by ``serializer`` (see
+    ``formwizard.storage.serializers``). Serialized states of at least
+    ``compress_threshold`` bytes are compressed.
+
+    ``file_dedup`` enables deduplication of uploaded files, based on a digest
+    of their content (using ``file_hash_algorithm``). Files are only stored
+    once per wizard (``'wizard'``), or once across all wizards that use
+    ``WizardFile`` as an index (``'global'``). For the latter, the number of
+    wizards that reference each file is counted in ``WizardFile.refcount``.
+
+    Uploaded files are saved one after another, unless ``file_save_workers``
+    is greater than one, in which case they're saved concurrently. With
+    ``file_save_async`` they're saved in the background, see
+    ``_save_files()``.
+
+    Uploaded files are streamed to the file storage in chunks of
+    ``file_chunk_size`` bytes. The size of each file can be limited via
+    ``file_max_size``, and the combined size of all files in the wizard via
+    ``file_max_total_size`` (both in bytes). Wizard views report uploads
+    that exceed either as form errors (see ``check_file_sizes()``), and
+    files that turn out to be larger than they claimed raise
+    ``FileTooLarge`` while they're saved.
+
+    With ``delete_orphaned_files``, files that the state stops referring to
+    (e.g. because a step's files were replaced, or the wizard was reset or
+    deleted) are deleted from the file storage once the state is written.
+    This is off by default, as ``done()`` may return a response that uses
+    the files after the wizard has been reset. Files that are tracked in
+    ``WizardFile`` (``track_files``, implied by global deduplication) are
+    deleted by the ``clearwizardfiles`` management command once they haven't
+    been used for a while, which also covers abandoned wizards.
+
+    Storages that keep a version counter with the state detect when it was
+    written by a concurrent request (e.g. a second tab, or a double-click)
+    since it was decoded. ``on_conflict`` determines what happens then:
+    ``'merge'`` merges the steps this request changed into the stored state
+    (see ``resolve_conflict()``), retrying up to ``conflict_retries`` times,
+    ``'raise'`` raises ``StateConflict``, and ``None`` disables the detection
+    (the last write wins).
     """
     step_class = Step
+    lazy_decode = False
+    serializer = serializers.JSONSerializer()
+    compress_threshold = None
+    compress_level = 6
+    file_dedup = None
+    file_hash_algorithm = 'sha1'
+    file_save_workers = None
+    file_save_async = False
+    file_save_timeout = 30
+    file_chunk_size = 64 * 2 ** 10
+    file_max_size = None
+    file_max_total_size = None
+    delete_orphaned_files = False
+    track_files = False
+    on_conflict = 'merge'
+    conflict_retries = 3
 
     def __init__(self, name, namespace, file_storage=None):
         self.name = name
         self.namespace = namespace
         self.file_storage = file_storage
-        self.steps = {}
-        self.current_step = None
+        self._steps = {}
+        self._current_step = None
+        # Snapshot of what's persisted, used to determine ``modified``
+        self._stored_current_step = None
+        self._stored_step_names = set()
+        self._steps_modified = False
+        self._stored_files = {}
+        self._written_files = set()
+        self._decoded_files = []
+
+    @property
+    def steps(self):
+        return self._steps
+
+    @steps.setter
+    def steps(self, value):
+        self._steps = value
+        self._steps_modified = True
+
+    @property
+    def current_step(self):
+        return self._current_step
+
+    @current_step.setter
+    def current_step(self, step):
+        self._current_step = step
+
+    @property
+    def modified(self):
+        """
+        ``True`` if the state has changed since it was decoded, i.e. whether
+        it needs to be written back to the storage.
+        """
+        current = self.current_step
+        name = None if current is None else current.name
+        if name != self._stored_current_step:
+            return True
+        if self._steps_modified:
+            return True
+        if self._stored_step_names.difference(self.steps):
+            return True  # e.g. ``del storage.steps[name]``
+        return any(step.modified for step in self._decoded_steps())
+
+    def _decoded_steps(self):
+        """
+        Returns the ``Step`` objects in ``steps``, excluding any that are yet
+        to be decoded.
+        """
+        if isinstance(self.steps, LazySteps):
+            return self.steps.decoded()
+        return self.steps.values()
 
     def process_request(self, request):
         """
@@ -71,11 +410,87 @@ class Storage(object):
         """
         pass
 
+    def commit(self):
+        """
+        Called by storages once the state has been written, or deleted.
+
+        Updates the reference counts of globally deduplicated files that the
+        state started or stopped referencing, and deletes files that are no
+        longer referenced (see ``delete_orphaned_files``). Globally
+        deduplicated files may still be referenced by other wizards, they're
+        left to ``clearwizardfiles``.
+        """
+        files, stored = self._referenced_files(), self._stored_files
+        orphaned = [key for key in set(stored) | self._written_files
+                    if key not in files]
+        if self.file_dedup == 'global':
+            WizardFile.objects.acquire([k for k, digest in files.iteritems()
+                                        if digest and k not in stored])
+            WizardFile.objects.release([k for k, digest in stored.iteritems()
+                                        if digest and k not in files])
+        if self.file_dedup == 'global' or self.track_files:
+            WizardFile.objects.touch(files.keys())
+        if self.delete_orphaned_files and self.file_dedup != 'global':
+            self._delete_files(orphaned)
+        self._stored_files = files
+        self._written_files = set()
+
+    def resolve_conflict(self, ours, theirs):
+        """
+        Called by storages that detect that the state was written by another
+        request since it was decoded. *ours* is the encoded state of this
+        request, *theirs* the encoded state that's stored now. Returns the
+        state to write instead of *ours*, or raises ``StateConflict`` unless
+        ``on_conflict`` is ``'merge'``.
+
+        Steps that this request added, changed or removed are taken from
+        *ours*, all other steps from *theirs*. The current step is taken from
+        *ours*. If the steps were replaced (e.g. by ``reset()``), *ours* wins
+        outright.
+        """
+        if self.on_conflict != 'merge':
+            raise StateConflict('The state of wizard "%s" was changed by '
+                                'another request' % self.name)
+        if self._steps_modified:
+            return ours
+        changed = set(step.name for step in self._decoded_steps()
+                      if step.modified)
+        steps = dict(theirs['steps'])
+        for name, attrs in ours['steps'].iteritems():
+            if name in changed:
+                steps[name] = attrs
+            elif name not in self._stored_step_names:
+                # accessing a step creates it, so it may be blank
+                steps.setdefault(name, attrs)
+        for name in self._stored_step_names.difference(ours['steps']):
+            steps.pop(name, None)
+        return {'current_step': ours['current_step'], 'steps': steps}
+
+    def close(self):
+        """
+        Closes any files that were opened since the state was decoded. This
+        is called once the request has been handled.
+        """
+        for uploaded_file in self._decoded_files:
+            uploaded_file.close()
+        self._decoded_files = []
+
     def reset(self):
         """
         Reset the storage for the current wizard back to a clean initial state.
         """
-        self.steps = {}
+        # Dropping steps that never held any data doesn't change the state
+        # in a meaningful way, so it doesn't warrant a write.
+        blank = all(step.data is None and step.files is None
+                    for step in self._decoded_steps())
+        if isinstance(self.steps, LazySteps):
+            blank = blank and all(
+                    attrs['data'] is None and attrs['files'] is None
+                    for attrs in self.steps.pending.itervalues())
+        self._steps_modified = self._steps_modified or not blank
+        if blank:
+            self._stored_step_names = set()  # see ``modified``
+        self._steps = {}
         self.current_step = None
 
     def delete(self):
@@ -114,49 +529,291 @@ class Storage(object):
         a new ``dict`` it returned with the structure::
 
             {
-                "<field_name>": <UploadedFile object>,
+                "<field_name>": <LazyUploadedFile object>,
                 ...
             }
 
+        The files aren't opened until their contents are accessed, and are
+        closed by ``close()``.
         """
         if files is None:
             return None
         decoded = {}
         for name, data in files.iteritems():
+            data = dict(data)  # don't modify the encoded form
             key = data.pop('file_storage_key')
-            uploaded_file = UploadedFile(file=self.file_storage.open(key),
-                                         **data)
+            digest = data.pop('digest', None)
+            pending = data.pop('pending', False)
             # In order to ensure that files aren't repeatedly saved to the file
             # storage, the filename of each file in the file storage is added
             # to ``UploadedFile`` objects as a ``_wizard_file_storage_key``
             # attribute when they're decoded. This acts as a marker to indicate
             # that the file already exists in the file storage.
-            uploaded_file._wizard_file_storage_key = key
+            uploaded_file = LazyUploadedFile(self.file_storage, key,
+                                             pending=pending,
+                                             timeout=self.file_save_timeout,
+                                             chunk_size=self.file_chunk_size,
+                                             **data)
+            uploaded_file._wizard_file_digest = digest
+            self._decoded_files.append(uploaded_file)
             decoded[name] = uploaded_file
         return decoded
 
     def _encode_files(self, files):
         """
         Performs the opposite conversion to ``_decode_files()``.
+
+        Files that aren't in the file storage yet are saved. If ``file_dedup``
+        is enabled, the digest of each file is included as ``"digest"``.
         """
         if files is None:
             return None
         if files and not self.file_storage:
             raise NoFileStorageConfigured
+        # files that are saved are marked, in case the state is encoded again
+        self._save_files([uploadedfile for uploadedfile in files.itervalues()
+                          if not hasattr(uploadedfile,
+                                         '_wizard_file_storage_key')])
         encoded = {}
         for name, uploadedfile in files.iteritems():
-            key = getattr(uploadedfile, '_wizard_file_storage_key', None)
-            if key is None:
-                key = self.file_storage.save(uploadedfile.name, uploadedfile)
             encoded[name] = {
-                'file_storage_key': key,
+                'file_storage_key': uploadedfile._wizard_file_storage_key,
                 'name': uploadedfile.name,
                 'content_type': uploadedfile.content_type,
                 'size': uploadedfile.size,
                 'charset': uploadedfile.charset
             }
+            digest = getattr(uploadedfile, '_wizard_file_digest', None)
+            if digest is not None:
+                encoded[name]['digest'] = digest
+            if getattr(uploadedfile, '_wizard_file_pending', False):
+                encoded[name]['pending'] = True
         return encoded
 
+    def _save_files(self, uploadedfiles):
+        """
+        Saves *uploadedfiles* to the file storage, and marks each with the
+        key it was saved as (see ``_decode_files()``).
+
+        If ``file_dedup`` is enabled, files whose content is already stored
+        aren't saved again.
+
+        If ``file_save_workers`` is greater than one, the files are saved
+        concurrently on a pool of that many threads. This returns once all
+        files are saved, and raises the first error that occurred, if any
+        (after deleting the files that were saved).
+
+        If ``file_save_async`` is enabled, the files are saved by the pool in
+        the background, and marked as *pending* in the encoded state. Opening
+        a pending file waits up to ``file_save_timeout`` seconds for it to be
+        saved (see ``formwizard.storage.files.settle()``).
+        """
+        unsaved = []
+        by_digest = {}
+        for uploadedfile in uploadedfiles:
+            # before any file is read to compute its digest
+            self._check_file_size(uploadedfile)
+        for uploadedfile in uploadedfiles:
+            key, digest = self._find_file(uploadedfile)
+            uploadedfile._wizard_file_digest = digest
+            if key is not None:
+                uploadedfile._wizard_file_storage_key = key
+            elif digest is not None and digest in by_digest:
+                by_digest[digest].append(uploadedfile)  # duplicate upload
+            else:
+                by_digest.setdefault(digest, []).append(uploadedfile)
+                unsaved.append(uploadedfile)
+        if not unsaved:
+            return
+
+        store = partial(self._store_file, limit=self.file_max_size,
+                        budget=self._file_budget(unsaved))
+        if self.file_save_async:
+            pool = get_pool(self.file_save_workers or 1)
+            keys = [save_async(pool, store, uploadedfile)
+                    for uploadedfile in unsaved]
+        else:
+            concurrent = self.file_save_workers > 1 and len(unsaved) > 1
+            if concurrent:
+                pool = get_pool(self.file_save_workers)
+                saves = [pool.apply_async(store, (uploadedfile, )).get
+                         for uploadedfile in unsaved]
+            else:
+                saves = [partial(store, uploadedfile)
+                         for uploadedfile in unsaved]
+            keys, error = [], None
+            for save in saves:
+                try:
+                    keys.append(save())
+                except Exception:
+                    error = error or sys.exc_info()
+                    if not concurrent:
+                        break
+            if error:
+                # the files that were saved would never be referenced
+                for key in keys:
+                    self.file_storage.delete(key)
+                raise error[0], error[1], error[2]
+
+        for uploadedfile, key in zip(unsaved, keys):
+            digest = uploadedfile._wizard_file_digest
+            for saved in by_digest[digest] if digest else [uploadedfile]:
+                saved._wizard_file_storage_key = key
+                saved._wizard_file_pending = self.file_save_async
+            self._written_files.add(key)
+            if self.file_dedup == 'global' or self.track_files:
+                WizardFile.objects.create(key=key, digest=digest or '')
+
+    def _find_file(self, uploadedfile):
+        """
+        Looks for a stored file with the same content as *uploadedfile*.
+
+        :returns: ``(key, digest)``. *key* is ``None`` if there's no such
+                  file, *digest* is ``None`` if ``file_dedup`` isn't enabled.
+        """
+        if not self.file_dedup:
+            return None, None
+        digest = self._file_digest(uploadedfile)
+        if self.file_dedup == 'global':
+            for key in (WizardFile.objects.filter(digest=digest)
+                                          .values_list('key', flat=True)):
+                if self.file_storage.exists(key):
+                    return key, digest
+            return None, digest
+        for key, stored_digest in self._referenced_files().iteritems():
+            if stored_digest == digest:
+                return key, digest
+        return None, digest
+
+    def _store_file(self, uploadedfile, name=None, limit=None, budget=None):
+        """
+        Streams *uploadedfile* to the file storage as *name* (by default its
+        file name), and returns the key it was saved as.
+
+        If more than *limit* bytes are read, or the bytes read exceed
+        *budget* (a ``SizeBudget``), the partially saved file is deleted and
+        ``FileTooLarge`` is raised.
+        """
+        name = self.file_storage.get_available_name(name or uploadedfile.name)
+        content = StreamedFile(uploadedfile, self.file_chunk_size, limit,
+                               budget)
+        try:
+            return self.file_storage.save(name, content)
+        except FileTooLarge:
+            if self.file_storage.exists(name):
+                self.file_storage.delete(name)
+            raise
+
+    def _delete_files(self, keys):
+        """
+        Deletes the files with the given *keys* from the file storage.
+        """
+        if not keys:
+            return
+        for key in keys:
+            self.file_storage.delete(key)
+        if self.track_files:
+            WizardFile.objects.filter(key__in=keys).delete()
+
+    def _check_file_size(self, uploadedfile, size=None):
+        """
+        Checks the size that *uploadedfile* claims to have (or *size*, if
+        given) against ``file_max_size``.
+        """
+        if size is None:
+            size = uploadedfile.size or 0
+        if self.file_max_size is not None and size > self.file_max_size:
+            raise FileTooLarge('"%s" exceeds the maximum size of %d bytes'
+                               % (uploadedfile.name, self.file_max_size))
+
+    def check_file_sizes(self, uploadedfiles, step=None):
+        """
+        Checks the sizes that *uploadedfiles* claim to have against
+        ``file_max_size``, and their combined size (along with the files of
+        the other steps, if they're to become the files of *step*) against
+        ``file_max_total_size``. Raises ``FileTooLarge`` if either is
+        exceeded.
+        """
+        for uploadedfile in uploadedfiles:
+            self._check_file_size(uploadedfile)
+        if self.file_max_total_size is None:
+            return
+        size = sum(uploadedfile.size or 0 for uploadedfile in uploadedfiles)
+        if size + self._stored_files_size(exclude=step) \
+                > self.file_max_total_size:
+            raise FileTooLarge('The files exceed the maximum total size of '
+                               '%d bytes' % self.file_max_total_size)
+
+    def _file_budget(self, uploadedfiles):
+        """
+        Checks the combined size that *uploadedfiles* claim to have against
+        ``file_max_total_size``, and returns the ``SizeBudget`` that they're
+        streamed against, as they may turn out to be larger (``None`` for
+        unlimited).
+        """
+        if self.file_max_total_size is None:
+            return None
+        available = self.file_max_total_size - self._stored_files_size()
+        if sum(uploadedfile.size or 0 for uploadedfile in uploadedfiles) \
+                > available:
+            raise FileTooLarge('The files exceed the maximum total size of '
+                               '%d bytes' % self.file_max_total_size)
+        return SizeBudget(available, self.file_max_total_size)
+
+    def _file_digest(self, uploadedfile):
+        """
+        Returns the hex digest of the content of *uploadedfile*, which is
+        checked against ``file_max_size`` as it's read.
+        """
+        digest = hashlib.new(self.file_hash_algorithm)
+        size = 0
+        for chunk in uploadedfile.chunks(self.file_chunk_size):
+            size += len(chunk)
+            self._check_file_size(uploadedfile, size)
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def _referenced_files(self):
+        """
+        Returns the files in the file storage that the state refers to, as a
+        ``dict`` mapping key to digest (``None`` if unknown). Files that
+        haven't been saved yet are excluded.
+        """
+        files = {}
+        if isinstance(self.steps, LazySteps):
+            for attrs in self.steps.pending.itervalues():
+                for data in (attrs['files'] or {}).itervalues():
+                    files[data['file_storage_key']] = data.get('digest')
+        for step in self._decoded_steps():
+            for uploadedfile in (step.files or {}).itervalues():
+                key = getattr(uploadedfile, '_wizard_file_storage_key', None)
+                if key is not None:
+                    files[key] = getattr(uploadedfile, '_wizard_file_digest',
+                                         None)
+        return files
+
+    def _stored_files_size(self, exclude=None):
+        """
+        Returns the combined size of the files in the file storage that the
+        state refers to (apart from those of the step *exclude*).
+        """
+        sizes = {}
+        excluded = None if exclude is None else exclude.name
+        if isinstance(self.steps, LazySteps):
+            for name, attrs in self.steps.pending.iteritems():
+                if name == excluded:
+                    continue
+                for data in (attrs['files'] or {}).itervalues():
+                    sizes[data['file_storage_key']] = data.get('size') or 0
+        for step in self._decoded_steps():
+            if step.name == excluded:
+                continue
+            for uploadedfile in (step.files or {}).itervalues():
+                key = getattr(uploadedfile, '_wizard_file_storage_key', None)
+                if key is not None:
+                    sizes[key] = uploadedfile.size or 0
+        return sum(sizes.itervalues())
+
     def encode(self):
         """
         Encodes the current wizard state to a ``dict``::
@@ -179,21 +836,71 @@ class Storage(object):
             'current_step': None if current is None else current.name,
             'steps': {},
         }
-        for step in self.steps.itervalues():
+        if isinstance(self.steps, LazySteps):
+            # steps that were never decoded can't have been changed
+            data['steps'].update(self.steps.pending)
+        for step in self._decoded_steps():
             data['steps'][step.name] = {
                 'files': self._encode_files(step.files),
-                'data': step.data,
+                'data': None if step.data is None else step.data.to_dict(),
             }
         return data
 
+    def serialize(self, data):
+        """
+        Returns the state *data* (as returned by ``encode()``) serialized as
+        ASCII text, using ``serializer`` (JSON if it's ``None``).
+        """
+        serializer = self.serializer or serializers.JSONSerializer()
+        return serializers.dumps(data, serializer,
+                                 compress_threshold=self.compress_threshold,
+                                 compress_level=self.compress_level)
+
+    def deserialize(self, data):
+        """
+        Performs the reverse operation to ``serialize()``. Any of the
+        registered serializers' formats is accepted.
+        """
+        return serializers.loads(data)
+
+    def _dumps(self, value):
+        """
+        Returns the encoded state (or step) *value* as it's kept by storages
+        whose backend holds objects rather than text (e.g. sessions and
+        caches): as is, unless ``serializer`` or ``compress_threshold`` is
+        specified, in which case it's serialized.
+        """
+        if self.serializer is None and self.compress_threshold is None:
+            return value
+        return self.serialize(value)
+
+    def _loads(self, value):
+        """
+        Performs the reverse operation to ``_dumps()``.
+        """
+        if isinstance(value, basestring):
+            return self.deserialize(value)
+        return value
+
+    def _decode_step(self, name, attrs):
+        """
+        Returns a ``Step`` object from its encoded form.
+        """
+        return self.step_class(name, data=attrs['data'],
+                               files=self._decode_files(attrs['files']))
+
     def decode(self, data):
         """
         Performs reverse operation to ``encode()``.
+
+        The decoded state is considered unmodified.
         """
-        for name, attrs in data['steps'].iteritems():
-            self.steps[name] = self.step_class(
-                    name, data=attrs['data'],
-                    files=self._decode_files(attrs['files']))
+        if self.lazy_decode:
+            self._steps = LazySteps(self._decode_step, data['steps'])
+        else:
+            self._steps = {}
+            for name, attrs in data['steps'].iteritems():
+                self._steps[name] = self._decode_step(name, attrs)
         # It's important to set the current step *after* creating all the Step
         # objects, so that ``self.current_step`` refers to an object in
         # ``self.steps``
@@ -201,3 +908,62 @@ class Storage(object):
             self.current_step = None
         else:
             self.current_step = self[data['current_step']]
+        self._stored_current_step = data['current_step']
+        self._stored_step_names = set(data['steps'])
+        self._steps_modified = False
+        self._stored_files = self._referenced_files()
+
+
+class ScopedStorageMixin(object):
+    """
+    A mixin for storages that keep states on the server, which scopes them
+    to the authenticated user, or else the session. This is implicit with
+    cookie and session storages, but it must be done explicitly for these.
+    """
+    def _set_owner(self, request):
+        """
+        Determines the owner of the state from *request*, preferably the
+        user, but falling back to the session is supported.
+        """
+        try:
+            assert request.user.is_authenticated()
+            self._user = request.user
+        except (AssertionError, AttributeError):
+            if not hasattr(request, 'session'):
+                raise ImproperlyConfigured(
+                        '%s requires that the sessions middleware is enabled.'
+                        % type(self).__name__)
+            self._user = None
+        self._request = request
+
+    def _owner(self, create=False):
+        """
+        Returns the lookup arguments for the owner of the state (``user`` or
+        ``session_key``). Returns ``None`` if the session doesn't have a key
+        yet, unless *create* is ``True``, in which case the session is saved
+        to get one.
+        """
+        if self._user is not None:
+            return {'user': self._user}
+        session = self._request.session
+        if not session.session_key:
+            if not create:
+                return None
+            # Starting in Django 1.4, the session_key isn't determined
+            # until the first response is handled by the middleware.
+            # We get around this by manually saving the session to trigger
+            # the creation of session_key. As it's still empty, it must be
+            # marked as modified for the middleware to send its cookie.
+            session.save()
+            session.modified = True
+        return {'session_key': session.session_key}
+
+    def _owner_key(self, prefix, owner):
+        """
+        Returns a cache key for the state of the wizard of *owner* (lookup
+        arguments as returned by ``_owner()``), starting with *prefix*.
+        """
+        owner = (('user', owner['user'].pk) if 'user' in owner
+                 else ('session', owner['session_key']))
+        key = '%s|%s|%s|%s' % ((self.namespace, self.name) + owner)
+        return '%s.%s' % (prefix, hashlib.md5(smart_str(key)).hexdigest())
@@ -0,0 +1,75 @@
+from __future__ import absolute_import, unicode_literals
+from django.core.cache import get_cache
+from formwizard.storage.base import ScopedStorageMixin, Storage
+import time
+
+
+class CacheStorage(ScopedStorageMixin, Storage):
+    """
+    A storage that stores the state in a cache (``cache`` is the alias).
+
+    Like ``DatabaseStorage``, states are scoped to the authenticated user,
+    or else the session. States expire once they haven't been used for
+    ``timeout`` seconds. Using a state extends its lifetime, to spare a write
+    to the cache on every request, a state that's unchanged is only written
+    back once half of ``timeout`` has passed.
+
+    By default the state is stored as a ``dict`` and left to the cache to
+    pickle. If ``serializer`` or ``compress_threshold`` is specified, it's
+    stored serialized instead.
+    """
+    cache = 'default'
+    timeout = 24 * 60 * 60
+    serializer = None
+
+    def __init__(self, *args, **kwargs):
+        super(CacheStorage, self).__init__(*args, **kwargs)
+        self._deleted = False
+        self._entry = None  # ``(written at, data)`` as read from the cache
+
+    def process_request(self, request):
+        self._set_owner(request)
+        key = self._key()
+        if key is not None:
+            self._entry = self._cache().get(key)
+        if self._entry is None:
+            self.decode({'current_step': None, 'steps': {}})
+        else:
+            self.decode(self._loads(self._entry[1]))
+
+    def process_response(self, response):
+        if self._deleted:
+            return
+        if self.modified:
+            if self.steps or self.current_step:
+                self._set(self._dumps(self.encode()))
+            elif self._entry is not None:
+                self._cache().delete(self._key())
+            self.commit()
+        elif (self._entry is not None
+                and time.time() - self._entry[0] > self.timeout / 2):
+            self._set(self._entry[1])
+
+    def delete(self):
+        key = self._key()
+        if key is not None:
+            self._cache().delete(key)
+        self.reset()
+        self.commit()
+        self._deleted = True
+
+    def _key(self, create=False):
+        """
+        Returns the cache key of the state, or ``None`` (see ``_owner()``).
+        """
+        owner = self._owner(create)
+        if owner is None:
+            return None
+        return self._owner_key('formwizard.cache', owner)
+
+    def _cache(self):
+        return get_cache(self.cache)
+
+    def _set(self, data):
+        self._entry = (time.time(), data)
+        self._cache().set(self._key(create=True), self._entry, self.timeout)
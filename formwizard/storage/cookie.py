@@ -1,53 +1,486 @@
 from __future__ import absolute_import, unicode_literals
+from Cookie import SimpleCookie
 from django.conf import settings
+from django.core.cache import get_cache
 from django.core.exceptions import SuspiciousOperation
+from django.http import parse_cookie
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import iri_to_uri, smart_str
+from django.utils.http import base36_to_int, int_to_base36
 from formwizard.storage import Storage
+from formwizard.storage.lru import freeze, LRUCache, sizeof
 import hashlib
 import hmac
-import json
+import time
+import uuid
+
+
+try:
+    compare_digest = hmac.compare_digest
+except AttributeError:  # Python < 2.7.7
+    compare_digest = constant_time_compare
+
+
+# Keyed HMAC objects, by (secret, cookie key, digest). Hashing the key is
+# done once, signing copies the object.
+_hmacs = {}
+
+
+def _keyed_hmac(secret, key, digest):
+    try:
+        mac = _hmacs[(secret, key, digest)]
+    except KeyError:
+        mac = hmac.new(b'%s$%s' % (smart_str(secret), key),
+                       digestmod=getattr(hashlib, digest))
+        _hmacs[(secret, key, digest)] = mac
+    return mac.copy()
 
 
 class CookieStorage(Storage):
     """
     A storage that stores form data in a cookie given to the user. Files remain
     stored in the provided file storage.
+
+    Browsers only accept cookies up to about 4KB, so if the state doesn't fit
+    into ``max_cookie_size`` bytes it's split across several cookies named
+    ``<key>|1``, ``<key>|2``, etc. The cookie named ``<key>`` then holds a
+    manifest (``chunks-<count>``) rather than the state. At most
+    ``max_cookie_chunks`` chunks are accepted from a request.
+
+    If ``overflow_threshold`` is set, states larger than that many bytes are
+    stored in the ``overflow_cache`` cache instead, and the cookie only holds
+    a signed pointer to the entry (``@<token>.<version>``). The version is
+    incremented with every write, so replaying an outdated cookie yields an
+    empty state, as does an entry that has expired. Entries expire after
+    ``overflow_timeout`` seconds (``SESSION_COOKIE_AGE`` if ``None``), and
+    are deleted once the state is emptied (e.g. by ``reset()``).
+
+    The cookies are restricted to ``cookie_path``, which wizard views set to
+    the URL path of the wizard. Cookies that were set for ``/`` before (by
+    earlier releases) are ignored if they're sent along with the current
+    ones, and deleted.
+
+    Cookies are signed with an HMAC of ``hmac_digest`` (the name of a
+    ``hashlib`` constructor, e.g. ``'sha256'``, or ``'blake2b'`` where
+    available), keyed with ``SECRET_KEY``. Cookies signed with one of the
+    keys in the ``SECRET_KEY_FALLBACKS`` setting are accepted too, so that
+    the secret key can be rotated. If ``max_age`` is set, a timestamp is
+    signed along with the state, and cookies older than that many seconds
+    decode to an empty state.
+
+    Decoded states are cached in ``decoded_states`` (shared by all instances
+    in a process, ``None`` disables it), keyed by the exact cookie value, so
+    that requests with an unchanged cookie skip verifying and deserializing
+    it. Cached states are immutable (see ``formwizard.storage.lru.freeze``),
+    and count against the cache's ``max_size`` with the memory they take up
+    once decoded.
     """
-    # explicitly specifying the separators removes extraneous JSON whitespace
-    encoder = json.JSONEncoder(separators=(',', ':'))
+    max_cookie_size = 4000
+    max_cookie_chunks = 20
+    manifest_prefix = 'chunks-'
+    cookie_path = '/'
+    overflow_threshold = None
+    overflow_cache = 'default'
+    overflow_timeout = None
+    overflow_prefix = '@'
+    hmac_digest = 'sha1'
+    max_age = None
+    timestamp_prefix = 't'
+    decoded_states = LRUCache(max_entries=1000, max_size=8 * 2 ** 20)
 
     def __init__(self, *args, **kwargs):
         super(CookieStorage, self).__init__(*args, **kwargs)
         self.key = ('%s|%s' % (self.namespace, self.name)).encode('utf-8')
         self._delete = False
+        self._chunk_cookies = []
+        self._overflow_token = None
+        self._overflow_version = 0
+        self._shadowed_cookies = set()
 
     def process_request(self, request):
-        self.decode(request.COOKIES.get(self.key, ''))
+        cookies = self._request_cookies(request)
+        self._track_chunks(cookies)
+        self.decode(self._read_cookie(cookies, self.key))
 
     def process_response(self, response):
-        if not self._delete and (self.steps or self.current_step):
-            response.set_cookie(self.key, self.encode())
+        self._delete_shadowed_cookies(response)
+        if self._delete or not self.modified:
+            return  # nothing to write
+        if self.steps or self.current_step:
+            data = self.encode()
+            if (self.overflow_threshold is not None
+                    and len(data) > self.overflow_threshold):
+                data = self._overflow(data)
+            else:
+                self._drop_overflow()
+            self._write_cookie(response, self.key, data)
+            self.commit()
+        else:
+            self._drop_overflow()
 
     def delete(self):
         self.reset()
+        self.commit()
+        self._drop_overflow()
         self._delete = True
 
     def decode(self, data):
-        # check integrity
-        hmac, _, payload = data.partition('$')
-        if payload:
-            if hmac != self.hmac(payload):
-                raise SuspiciousOperation('Form wizard cookie manipulated')
-            decoded = json.loads(payload, cls=json.JSONDecoder)
-        else:
-            decoded = {'current_step': None, 'steps': {}}
+        cache, decoded = self.decoded_states, None
+        if cache is not None and data:
+            # the signature depends on all of these
+            cache_key = (self.key, self.hmac_digest, settings.SECRET_KEY, data)
+            decoded = cache.get(cache_key)
+            if (decoded is not None and self.max_age is not None
+                    and self._check_age(data.partition('$')[2]) is None):
+                decoded = {'current_step': None, 'steps': {}}  # expired
+        if decoded is None:
+            payload = self.unsign(data)
+            if payload is None:
+                decoded = {'current_step': None, 'steps': {}}
+            elif payload.startswith(self.overflow_prefix):
+                # the state behind a pointer may change, so it's not cached
+                data = self._load_overflow(payload)
+                if data is not None:
+                    return self.decode(data)
+                decoded = {'current_step': None, 'steps': {}}
+            else:
+                decoded = freeze(self.deserialize(payload))
+                if cache is not None:
+                    # compressed cookies may decode to much larger states
+                    cache.set(cache_key, decoded, sizeof(decoded))
         super(CookieStorage, self).decode(decoded)
 
     def encode(self):
         data = super(CookieStorage, self).encode()
-        payload = self.encoder.encode(data)
+        return self.sign(self.serialize(data))
+
+    def sign(self, payload):
+        """
+        Returns *payload* prefixed with its signature (and a timestamp, if
+        ``max_age`` is set).
+        """
+        if self.max_age is not None:
+            payload = '%s%s$%s' % (self.timestamp_prefix,
+                                   int_to_base36(int(time.time())), payload)
         return '%s$%s' % (self.hmac(payload), payload)
 
-    def hmac(self, data):
-        key = b'%s$%s' % (settings.SECRET_KEY, self.key)
-        msg = data.encode('utf-8')
-        return hmac.new(key, msg, hashlib.sha1).hexdigest()
+    def unsign(self, data):
+        """
+        Performs the reverse operation to ``sign()``. Returns ``None`` if
+        *data* is empty or has expired, and raises ``SuspiciousOperation`` if
+        the signature is invalid.
+        """
+        # check integrity
+        hmac, _, payload = data.partition('$')
+        if not payload:
+            return None
+        if not self.verify(hmac, payload):
+            raise SuspiciousOperation('Form wizard cookie manipulated')
+        return self._check_age(payload)
+
+    def hmac(self, data, secret=None):
+        mac = _keyed_hmac(secret or settings.SECRET_KEY, self.key,
+                          self.hmac_digest)
+        mac.update(data.encode('utf-8'))
+        return mac.hexdigest()
+
+    def verify(self, signature, data):
+        """
+        Returns whether *signature* is valid for *data*, using the current
+        or one of the fallback secret keys.
+        """
+        signature = smart_str(signature)
+        if compare_digest(signature, self.hmac(data)):
+            return True
+        return any(compare_digest(signature, self.hmac(data, secret))
+                   for secret in getattr(settings, 'SECRET_KEY_FALLBACKS', ()))
+
+    def _check_age(self, payload):
+        """
+        Strips the timestamp from a verified *payload*. Returns ``None`` if
+        the payload has expired, or lacks a timestamp although ``max_age`` is
+        set.
+        """
+        timestamp, sep, rest = payload.partition('$')
+        # Serialized states and pointers never contain "$" unless they're
+        # JSON, which starts with "{".
+        if not (sep and timestamp.startswith(self.timestamp_prefix)):
+            return None if self.max_age is not None else payload
+        if self.max_age is not None:
+            age = time.time() - base36_to_int(timestamp[1:])
+            if age > self.max_age:
+                return None
+        return rest
+
+    @property
+    def _path(self):
+        # cookie attributes must be ASCII byte strings
+        return iri_to_uri(self.cookie_path)
+
+    def _overflow_key(self, token):
+        return 'formwizard.cookie.%s' % token
+
+    def _overflow(self, data):
+        """
+        Stores *data* in the overflow cache, and returns the cookie value that
+        points to it.
+        """
+        if self._overflow_token is None:
+            self._overflow_token = uuid.uuid4().hex
+            self._overflow_version = 0
+        self._overflow_version += 1
+        timeout = self.overflow_timeout
+        if timeout is None:
+            # ``None`` means the cache's default timeout to older versions of
+            # Django, but never to newer ones
+            timeout = settings.SESSION_COOKIE_AGE
+        get_cache(self.overflow_cache).set(
+                self._overflow_key(self._overflow_token),
+                (self._overflow_version, data), timeout)
+        return self.sign('%s%s.%d' % (self.overflow_prefix,
+                                      self._overflow_token,
+                                      self._overflow_version))
+
+    def _load_overflow(self, pointer):
+        """
+        Returns the data that the (verified) *pointer* refers to, or ``None``
+        if it's outdated or has expired.
+        """
+        token, _, version = pointer[len(self.overflow_prefix):].partition('.')
+        stored = get_cache(self.overflow_cache).get(self._overflow_key(token))
+        if stored is None or stored[0] != int(version):
+            return None
+        self._overflow_token, self._overflow_version = token, stored[0]
+        return stored[1]
+
+    def _drop_overflow(self):
+        if self._overflow_token is not None:
+            get_cache(self.overflow_cache).delete(
+                    self._overflow_key(self._overflow_token))
+            self._overflow_token = None
+
+    def _request_cookies(self, request):
+        """
+        Returns the cookies of *request*. Of several cookies of the wizard
+        with the same name, the first is used (rather than the last, as in
+        ``request.COOKIES``), and the others are remembered so that they're
+        deleted.
+
+        Browsers send the cookie with the most specific path first, so that's
+        the one set for ``cookie_path``, while the others were set for ``/``
+        before cookies were restricted to the wizard.
+        """
+        self._shadowed_cookies = set()
+        if self.cookie_path == '/':
+            return request.COOKIES
+        cookies, seen = dict(request.COOKIES), set()
+        for pair in request.META.get('HTTP_COOKIE', '').split(';'):
+            name = pair.partition('=')[0].strip()
+            if name != self.key and not name.startswith(self.key + b'|'):
+                continue
+            if name in seen:
+                self._shadowed_cookies.add(name)
+            else:
+                seen.add(name)
+                cookies.update(parse_cookie(pair))
+        return cookies
+
+    def _delete_shadowed_cookies(self, response):
+        """
+        Deletes the cookies of the wizard that are set for ``/`` as well as
+        for ``cookie_path`` (see ``_request_cookies()``).
+        """
+        for name in map(smart_str, self._shadowed_cookies):
+            cookie = SimpleCookie()
+            cookie[name] = ''
+            cookie[name].update({'path': '/', 'max-age': 0,
+                                 'expires': 'Thu, 01-Jan-1970 00:00:00 GMT'})
+            # ``response.cookies`` is keyed by name, and the cookie for
+            # ``cookie_path`` may be set as well, so this one is added under
+            # a key of its own (the header uses the name of the morsel)
+            dict.__setitem__(response.cookies, '%s (/)' % name, cookie[name])
+
+    def _track_chunks(self, cookies):
+        # chunks are tracked so that stale ones can be deleted
+        prefix = self.key + b'|'
+        self._chunk_cookies = [name for name in cookies
+                               if name.startswith(prefix)
+                               and name.rpartition(b'|')[2].isdigit()]
+
+    def _read_cookie(self, cookies, name):
+        """
+        Returns the value of the cookie *name*, reassembled from its chunks
+        if necessary.
+        """
+        data = cookies.get(name, '')
+        if data.startswith(self.manifest_prefix):
+            data = self._join_chunks(cookies, name, data)
+        return data
+
+    def _write_cookie(self, response, name, data):
+        """
+        Sets the cookie *name* to *data* (split into chunks if necessary),
+        and deletes chunks of its previous value that are no longer needed.
+        """
+        written = self._set_cookies(response, name, data)
+        for chunk in self._chunk_cookies:
+            if chunk.rpartition(b'|')[0] == name and chunk not in written:
+                response.delete_cookie(chunk, path=self._path)
+
+    def _delete_cookie(self, response, name):
+        response.delete_cookie(name, path=self._path)
+        for chunk in self._chunk_cookies:
+            if chunk.rpartition(b'|')[0] == name:
+                response.delete_cookie(chunk, path=self._path)
+
+    def _chunk_name(self, name, index):
+        return b'%s|%d' % (name, index)
+
+    def _join_chunks(self, cookies, name, manifest):
+        """
+        Reassembles the value of the cookie *name* from the chunks listed in
+        *manifest*. The result is verified by ``unsign()``.
+
+        Browsers drop cookies once they hit their limits on the number or
+        size of cookies per domain, so if a chunk is missing (or there are
+        too many), the cookie is treated as if it were missing.
+        """
+        count = manifest[len(self.manifest_prefix):]
+        if not count.isdigit() or int(count) > self.max_cookie_chunks:
+            return ''
+        chunks = [cookies.get(self._chunk_name(name, index))
+                  for index in xrange(1, int(count) + 1)]
+        if None in chunks:
+            return ''
+        return ''.join(chunks)
+
+    def _set_cookies(self, response, key, data):
+        """
+        Sets *data* as one or more cookies named after *key* on *response*,
+        and returns the names of the chunk cookies that were set.
+        """
+        if _cookie_size(key, data) <= self.max_cookie_size:
+            response.set_cookie(key, data, path=self._path)
+            return []
+        names = []
+        pos = 0
+        while pos < len(data):
+            name = self._chunk_name(key, len(names) + 1)
+            available = self.max_cookie_size - len(name)
+            end = pos + available
+            while True:
+                excess = _cookie_size(name, data[pos:end]) - self.max_cookie_size
+                if excess <= 0:
+                    break
+                end -= excess  # quoting only ever makes the value longer
+            response.set_cookie(name, data[pos:end], path=self._path)
+            names.append(name)
+            pos = end
+        response.set_cookie(key, '%s%d' % (self.manifest_prefix, len(names)),
+                            path=self._path)
+        return names
+
+
+class PerStepCookieStorage(CookieStorage):
+    """
+    A ``CookieStorage`` that stores each step in a cookie of its own
+    (``<key>|step-<hash of the step name>``). The cookie named ``<key>`` only
+    holds the current step and the names of the steps.
+
+    ``process_response`` only sets the cookies of steps that were modified
+    (and the ``<key>`` cookie if the current step or the set of steps
+    changed), so long wizards don't re-send their entire state with every
+    response. Each cookie is chunked if necessary, but states aren't moved to
+    the overflow cache.
+
+    If ``max_age`` is set, the state expires as a whole once any of its
+    cookies has expired. As cookies that aren't modified keep their
+    timestamp, all of them are signed again when the state is written once
+    the oldest is more than half ``max_age`` old.
+    """
+    def __init__(self, *args, **kwargs):
+        super(PerStepCookieStorage, self).__init__(*args, **kwargs)
+        self._header = None
+        self._cookie_steps = set()
+        self._signed_at = None  # time the oldest cookie was signed
+
+    def process_request(self, request):
+        cookies = self._request_cookies(request)
+        self._track_chunks(cookies)
+        data = self._read_cookie(cookies, self.key)
+        payload = self.unsign(data)
+        header = (self.deserialize(payload) if payload is not None
+                  else {'current_step': None, 'steps': []})
+        signed_at = [self._timestamp(data)] if payload is not None else []
+        steps = {}
+        for name in header['steps']:
+            data = self._read_cookie(cookies, self._step_key(name))
+            if not data:
+                continue  # e.g. evicted by the browser
+            payload = self.unsign(data)
+            if payload is None:
+                # expired, and the rest of the state with it
+                header = {'current_step': None, 'steps': []}
+                steps, signed_at = {}, []
+                break
+            attrs = self.deserialize(payload)
+            # the name guards against cookies being swapped between steps
+            if attrs.pop('name', None) != name:
+                raise SuspiciousOperation('Form wizard cookie manipulated')
+            steps[name] = attrs
+            signed_at.append(self._timestamp(data))
+        self._header = header
+        self._cookie_steps = set(steps)
+        if self.max_age is not None and signed_at:
+            self._signed_at = min(signed_at)
+        super(CookieStorage, self).decode({
+            'current_step': header['current_step'], 'steps': steps})
+
+    def process_response(self, response):
+        self._delete_shadowed_cookies(response)
+        if self._delete or not self.modified:
+            return  # nothing to write
+        if not (self.steps or self.current_step):
+            return
+        encoded = super(CookieStorage, self).encode()
+        # steps are all rewritten if they were replaced (e.g. by ``reset()``),
+        # or are about to expire
+        refresh = (self._signed_at is not None
+                   and time.time() - self._signed_at > self.max_age / 2.0)
+        rewrite = self._steps_modified or refresh
+        modified = set(step.name for step in self._decoded_steps()
+                       if step.modified)
+        for name, attrs in encoded['steps'].iteritems():
+            if rewrite or name in modified or name not in self._cookie_steps:
+                data = self.sign(self.serialize(dict(attrs, name=name)))
+                self._write_cookie(response, self._step_key(name), data)
+        for name in self._cookie_steps.difference(encoded['steps']):
+            self._delete_cookie(response, self._step_key(name))
+        header = {'current_step': encoded['current_step'],
+                  'steps': sorted(encoded['steps'])}
+        if header != self._header or refresh:
+            self._write_cookie(response, self.key,
+                               self.sign(self.serialize(header)))
+        self.commit()
+
+    def _timestamp(self, data):
+        """
+        Returns the time the (verified) cookie value *data* was signed at, or
+        ``None`` if it lacks a timestamp.
+        """
+        timestamp, sep, _ = data.partition('$')[2].partition('$')
+        if not (sep and timestamp.startswith(self.timestamp_prefix)):
+            return None
+        return base36_to_int(timestamp[len(self.timestamp_prefix):])
+
+    def _step_key(self, name):
+        digest = hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+        return b'%s|step-%s' % (self.key, digest)
+
+
+def _cookie_size(name, value):
+    """
+    Returns the size of the cookie *name* with *value*, as it's sent to the
+    browser (i.e. after quoting).
+    """
+    return len(name) + 1 + len(SimpleCookie().value_encode(value)[1])
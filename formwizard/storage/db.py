@@ -1,54 +1,509 @@
 from __future__ import absolute_import, unicode_literals
-from django.core.exceptions import ImproperlyConfigured
-from formwizard.storage import Storage
-from formwizard.models import WizardState
-import json
+from django.core.cache import get_cache
+from django.db import IntegrityError, router, transaction
+from django.db.models import F
+from datetime import timedelta
+from formwizard.storage.base import ScopedStorageMixin, Storage
+from formwizard.storage.exceptions import StateConflict
+from formwizard.models import now, WizardState, WizardStepState
+import calendar
+import collections
+import time
 
 
-class DatabaseStorage(Storage):
-    encoder = json.JSONEncoder(separators=(',', ':'))
+# Session key of a ``dict`` mapping each wizard to the time its state was last
+# written via the session (in seconds since the epoch), see
+# ``DatabaseStorage.read_database``.
+WRITTEN_AT_KEY = 'formwizard.db.written_at'
+
+
+def _epoch(value):
+    """
+    Returns the ``datetime`` *value* in seconds since the epoch.
+    """
+    if value.tzinfo is not None:
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+    return seconds + value.microsecond / 1e6
+
+
+class DatabaseStorage(ScopedStorageMixin, Storage):
+    """
+    A storage that stores the state in the database (``WizardState``).
+
+    The row is only read once the state is first accessed, and only created
+    once the state is first written. Writes are a single ``UPDATE``, falling
+    back to an ``INSERT`` if the row doesn't exist yet.
+
+    Writes are conditional on the row's ``version`` being the one that was
+    read (``UPDATE ... WHERE version = n``), so a concurrent write is
+    detected without locking the row, and handled as per ``on_conflict``.
+    A state that's reset without having been read is written regardless.
+
+    States that haven't been written for ``state_ttl`` seconds are treated
+    as if there were no state. They're deleted by the ``clearwizardstates``
+    management command.
+
+    If ``state_cache`` (a cache alias) is set, rows are read through that
+    cache, and written to it along with the database. Cached rows carry
+    their version, so a stale cache entry doesn't lose writes, it's merely
+    detected as a conflict when the state is written. Entries expire after
+    ``state_cache_timeout`` seconds (the cache's default if ``None``).
+
+    ``database`` is the alias of the database that holds the states (by
+    default, the database routers decide). If ``read_database`` is set,
+    states are read from that database (e.g. a replica) instead, unless
+    it's behind: the time of the last write made via the user's session is
+    kept in the session, and if the replica's row is older than that, the
+    state is read from ``database`` after all. Times are compared rather
+    than versions, as versions start over when a state is deleted. Wizard
+    views can choose both per wizard, see
+    ``WizardMixin.get_storage_databases()``.
+    """
+    state_ttl = None
+    state_cache = None
+    state_cache_timeout = None
+    database = None
+    read_database = None
 
     def __init__(self, *args, **kwargs):
         super(DatabaseStorage, self).__init__(*args, **kwargs)
         self._deleted = False
+        self._loaded = False
+        self._pk = None
+        self._version = None  # ``None`` if there's no row
+        self._written_at = None
+        # reset before the state was loaded, so it's unknown what's stored
+        self._blind = False
 
     def process_request(self, request):
-        kwargs = {'name': self.name, 'namespace': self.namespace}
-        # Either session or authentication information is used to scope the
-        # wizard state. This is implicit with using CookieStorage or
-        # SesssionStorage, but it must be done explicitly here. Preferably the
-        # User is used, but fallback to the session key is supported
-        try:
-            assert request.user.is_authenticated()
-            kwargs['user'] = request.user
-        except (AssertionError, AttributeError):
-            if not hasattr(request, 'session'):
-                raise ImproperlyConfigured(
-                        '%s requires that the sessions middleware is enabled.'
-                        % type(self).__name__)
-            if not request.session.session_key:
-                # Starting in Django 1.4, the session_key isn't determined
-                # until the first response is handled by the middleware.
-                # We get around this by manually saving the session to trigger
-                # the creation of session_key
-                request.session.save()
-            kwargs['session_key'] = request.session.session_key
-        self._state, created = WizardState.objects.get_or_create(**kwargs)
-        self.decode(self._state.data)
+        self._set_owner(request)
 
     def process_response(self, response):
-        if not self._deleted:
-            self._state.data = self.encode()
-            self._state.full_clean()
-            self._state.save()
+        if not self._deleted and self.modified:
+            scope = self._scope(create=True)
+            state = super(DatabaseStorage, self).encode()
+            if self._blind or self.on_conflict is None:
+                self._overwrite(scope, state)
+                self._uncache(scope)  # the version isn't known
+            else:
+                state = self._write(scope, state)
+                if self.state_cache is not None:
+                    get_cache(self.state_cache).set(
+                            self._cache_key(scope), self._cache_row(state),
+                            self.state_cache_timeout)
+            self._remember_write()
+            self.commit()
 
     def delete(self):
-        self._state.delete()
+        # the state is reset first, as that loads it if its files need to be
+        # released
         self.reset()
+        scope = self._scope()
+        if scope is not None:
+            self._written_at = now()
+            self._rows(scope).delete()
+            self._uncache(scope)
+            self._remember_write()
+        self.commit()
         self._deleted = True
 
+    def reset(self):
+        # Files that are referenced by the stored state can only be released
+        # if it's loaded.
+        if (self._loaded or self.file_dedup == 'global' or self.track_files
+                or self.delete_orphaned_files):
+            return super(DatabaseStorage, self).reset()
+        self._loaded = self._blind = True
+        self._steps = {}
+        self._current_step = None
+        self._steps_modified = True
+
     def encode(self):
-        return self.encoder.encode(super(DatabaseStorage, self).encode())
+        return self.serialize(super(DatabaseStorage, self).encode())
 
     def decode(self, data):
-        return super(DatabaseStorage, self).decode(json.loads(data))
+        return super(DatabaseStorage, self).decode(self.deserialize(data))
+
+    def _get_steps(self):
+        self._load()
+        return Storage.steps.fget(self)
+
+    def _set_steps(self, value):
+        self._load()
+        Storage.steps.fset(self, value)
+
+    steps = property(_get_steps, _set_steps)
+
+    def _get_current_step(self):
+        self._load()
+        return Storage.current_step.fget(self)
+
+    def _set_current_step(self, step):
+        self._load()
+        Storage.current_step.fset(self, step)
+
+    current_step = property(_get_current_step, _set_current_step)
+
+    @property
+    def modified(self):
+        return self._loaded and Storage.modified.fget(self)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        state = None
+        scope = self._scope()
+        if scope is not None:
+            state, self._version = self._fetch(scope, stale_ok=True)
+        super(DatabaseStorage, self).decode(state or self._empty_state())
+
+    def _empty_state(self):
+        return self.deserialize(WizardState._meta.get_field('data').default)
+
+    def _fetch(self, scope, stale_ok=False):
+        """
+        Returns ``(state, version)`` of the row, *state* is ``None`` if
+        there's no row or the state has expired. If *stale_ok* is ``True``,
+        the row is read through ``state_cache``, and from ``read_database``
+        (see ``_read()``).
+        """
+        if not stale_ok:
+            row = self._query(scope)
+        elif self.state_cache is None:
+            row = self._read(scope)
+        else:
+            cache, key = get_cache(self.state_cache), self._cache_key(scope)
+            row = cache.get(key)
+            if row is None:
+                row = self._read(scope)
+                # ``add()``, so that a concurrent write isn't overwritten
+                cache.add(key, row, self.state_cache_timeout)
+        self._pk, data, version, modified_at = row[:4]
+        if (self.state_ttl is not None and modified_at is not None
+                and modified_at < now() - timedelta(seconds=self.state_ttl)):
+            return None, version
+        return self._row_state(row), version
+
+    def _query(self, scope, database=None):
+        """
+        Returns ``(pk, data, version, modified_at)`` of the row, or
+        ``(None, None, None, None)`` if there's no row. The row is read from
+        *database* (by default ``database``).
+        """
+        rows = WizardState.objects.using(database or self.database) \
+                                  .filter(**scope) \
+                                  .values_list('pk', 'data', 'version',
+                                               'modified_at')
+        return next(iter(rows[:1]), (None, None, None, None))
+
+    def _read(self, scope):
+        """
+        Returns the row from ``read_database``, if it reflects the last write
+        made via the session, otherwise from ``database``.
+        """
+        session = getattr(self._request, 'session', None)
+        if self.read_database is not None and session is not None:
+            written_at = session.get(WRITTEN_AT_KEY, {}).get(self._wizard_key)
+            row = self._query(scope, self.read_database)
+            if written_at is None or (row[3] is not None
+                                      and _epoch(row[3]) >= written_at):
+                return row
+        return self._query(scope)
+
+    def _remember_write(self):
+        """
+        Records the time of the last write in the session, see ``_read()``.
+        """
+        session = getattr(self._request, 'session', None)
+        if self.read_database is None or session is None:
+            return
+        written = session.get(WRITTEN_AT_KEY, {})
+        written[self._wizard_key] = _epoch(self._written_at)
+        session[WRITTEN_AT_KEY] = written
+
+    @property
+    def _wizard_key(self):
+        return '%s|%s' % (self.namespace, self.name)
+
+    def _row_state(self, row):
+        """
+        Returns the encoded state of a *row* returned by ``_query()``.
+        """
+        return None if row[1] is None else self.deserialize(row[1])
+
+    def _cache_row(self, state):
+        """
+        Returns the row that ``_query()`` would return once the encoded
+        *state* is written.
+        """
+        return (self._pk, self.serialize(state), self._version,
+                self._written_at)
+
+    def _cache_key(self, scope):
+        return self._owner_key('formwizard.db', scope)
+
+    def _uncache(self, scope):
+        if self.state_cache is not None:
+            get_cache(self.state_cache).delete(self._cache_key(scope))
+
+    def _scope(self, create=False):
+        """
+        Returns the lookup arguments for the row of the wizard, or ``None``
+        (see ``_owner()``).
+        """
+        owner = self._owner(create)
+        if owner is None:
+            return None
+        return dict(owner, name=self.name, namespace=self.namespace)
+
+    def _overwrite(self, scope, state):
+        """
+        Writes the encoded *state* regardless of what's stored.
+        """
+        data = self.serialize(state)
+        if self._blind and not (self._steps or self._current_step):
+            # there's no point in creating a row for an empty state
+            self._update(scope, data)
+        elif not self._update(scope, data):
+            try:
+                # in a savepoint, as a failed INSERT would otherwise break an
+                # enclosing transaction (e.g. ``ATOMIC_REQUESTS``)
+                with transaction.atomic(using=self._write_database):
+                    self._create(scope, data)
+            except IntegrityError:  # created concurrently
+                self._update(scope, data)
+
+    def _write(self, scope, state):
+        """
+        Writes the encoded *state* if the row hasn't been written since it
+        was read, otherwise resolves the conflict with the stored state and
+        tries again.
+
+        :returns: the state that was written
+        """
+        for attempt in xrange(self.conflict_retries + 1):
+            data = self.serialize(state)
+            if self._version is None:
+                try:
+                    with transaction.atomic(using=self._write_database):
+                        self._create(scope, data)
+                    self._version = 1
+                    return state
+                except IntegrityError:  # created concurrently
+                    pass
+            elif self._update(scope, data, version=self._version):
+                self._version += 1
+                return state
+            theirs, self._version = self._fetch(scope)
+            state = self.resolve_conflict(state, theirs or self._empty_state())
+        raise StateConflict('Gave up writing the state of wizard "%s" after '
+                            '%d conflicts' % (self.name, attempt + 1))
+
+    def _update(self, scope, data, version=None):
+        """
+        Updates the row, if it exists (and has *version*, if specified).
+
+        :returns: the number of rows updated
+        """
+        rows = self._rows(scope)
+        self._written_at = now()
+        if version is None:
+            return rows.update(data=data, modified_at=self._written_at,
+                               version=F('version') + 1)
+        return rows.filter(version=version).update(
+                data=data, modified_at=self._written_at, version=version + 1)
+
+    def _create(self, scope, data):
+        """
+        Creates the row.
+        """
+        row = WizardState.objects.using(self.database).create(
+                data=data, version=1, **scope)
+        self._pk, self._written_at = row.pk, row.modified_at
+
+    def _rows(self, scope):
+        return WizardState.objects.using(self.database).filter(**scope)
+
+    @property
+    def _write_database(self):
+        return self.database or router.db_for_write(WizardState)
+
+
+class PerStepDatabaseStorage(DatabaseStorage):
+    """
+    A ``DatabaseStorage`` that stores each step in a row of its own
+    (``WizardStepState``). The ``WizardState`` row holds the current step,
+    the names of the steps and their file metadata, and only the rows of the
+    steps that changed are written.
+
+    The ``WizardState`` row, which carries the version, is written first,
+    and the step rows within the same transaction. A request whose write
+    conflicts with a concurrent one thus doesn't write any steps, and the
+    steps of a state are never seen half rewritten.
+
+    The rows of all steps are read in a single query, but a step is only
+    deserialized once it's accessed (``lazy_decode``). The file metadata is
+    kept in the ``WizardState`` row, as the files of all steps are needed to
+    keep track of the files the state refers to.
+
+    States stored by ``DatabaseStorage`` are read as well, and converted
+    when they're next written.
+    """
+    lazy_decode = True
+
+    def __init__(self, *args, **kwargs):
+        super(PerStepDatabaseStorage, self).__init__(*args, **kwargs)
+        # whether the steps are stored in rows of their own
+        self._step_rows = False
+
+    def _query(self, scope, database=None):
+        row = super(PerStepDatabaseStorage, self)._query(scope, database)
+        steps = ()
+        if row[0] is not None:
+            steps = tuple(WizardStepState.objects
+                                         .using(database or self.database)
+                                         .filter(state=row[0])
+                                         .values_list('name', 'data'))
+        return row + (steps, )
+
+    def _row_state(self, row):
+        self._step_rows = False
+        if row[1] is None:
+            return None
+        state = self.deserialize(row[1])
+        if isinstance(state['steps'], list):
+            data, files = dict(row[4]), state.pop('files')
+            state['steps'] = dict(
+                    (name, StepRow(self.deserialize, data[name], files[name]))
+                    for name in state['steps'] if name in data)
+            self._step_rows = True
+        return state
+
+    def _cache_row(self, state):
+        steps = tuple((name, self._step_data(attrs))
+                      for name, attrs in state['steps'].iteritems())
+        return (self._pk, self._index(state), self._version, self._written_at,
+                steps)
+
+    def encode(self):
+        state = super(DatabaseStorage, self).encode()
+        # steps that were never decoded are still ``StepRow`` objects
+        state['steps'] = dict((name, dict(attrs))
+                              for name, attrs in state['steps'].iteritems())
+        return self.serialize(state)
+
+    def _index(self, state):
+        files = dict((name, attrs['files'])
+                     for name, attrs in state['steps'].iteritems())
+        return self.serialize({'current_step': state['current_step'],
+                               'steps': sorted(state['steps']),
+                               'files': files})
+
+    def _step_data(self, attrs):
+        if isinstance(attrs, StepRow):
+            return attrs.data  # never decoded, so unchanged
+        return self.serialize(attrs)
+
+    def _overwrite(self, scope, state):
+        if self._pk is None:
+            rows = self._rows(scope).values_list('pk', flat=True)
+            self._pk = next(iter(rows[:1]), None)
+        index = self._index(state)
+        if self._pk is None:
+            if not (state['steps'] or state['current_step']):
+                return  # there's no point in creating a row for an empty state
+            try:
+                with transaction.atomic(using=self._write_database):
+                    self._create(scope, index)
+                    self._write_steps(state, stored=())
+                return
+            except IntegrityError:  # created concurrently
+                self._pk = self._rows(scope).values_list('pk', flat=True) \
+                                            .get()
+        with transaction.atomic(using=self._write_database):
+            self._update(scope, index)
+            self._write_steps(state, self._stored_step_names,
+                              rewrite=self._blind)
+
+    def _write(self, scope, state):
+        stored = self._stored_step_names  # the steps that have rows
+        for attempt in xrange(self.conflict_retries + 1):
+            index = self._index(state)
+            if self._pk is None:
+                try:
+                    with transaction.atomic(using=self._write_database):
+                        self._create(scope, index)
+                        self._write_steps(state, stored=())
+                    self._version = 1
+                    return state
+                except IntegrityError:  # created concurrently
+                    pass
+            else:
+                with transaction.atomic(using=self._write_database):
+                    if self._update(scope, index, version=self._version):
+                        self._write_steps(state, stored)
+                        self._version += 1
+                        return state
+            theirs, self._version = self._fetch(scope)
+            stored = set(theirs['steps']) if theirs else set()
+            state = self.resolve_conflict(state, theirs or self._empty_state())
+        raise StateConflict('Gave up writing the state of wizard "%s" after '
+                            '%d conflicts' % (self.name, attempt + 1))
+
+    def _write_steps(self, state, stored, rewrite=False):
+        """
+        Writes the rows of the steps in the encoded *state* that were added,
+        changed or removed, given the names of the steps that are *stored*
+        (or all of them, if *rewrite* is ``True``). Called once the
+        ``WizardState`` row was written, within the same transaction.
+        """
+        rows = WizardStepState.objects.using(self.database) \
+                                      .filter(state=self._pk)
+        if rewrite or self._steps_modified or not self._step_rows:
+            rows.delete()
+            rows.bulk_create([
+                    WizardStepState(state_id=self._pk, name=name,
+                                    data=self._step_data(attrs))
+                    for name, attrs in state['steps'].iteritems()])
+            self._step_rows = True
+            return
+        removed = set(stored).difference(state['steps'])
+        if removed:
+            rows.filter(name__in=removed).delete()
+        changed = set(step.name for step in self._decoded_steps()
+                      if step.modified)
+        for name, attrs in state['steps'].iteritems():
+            if name in stored and name not in changed:
+                continue
+            data = self._step_data(attrs)
+            if not rows.filter(name=name).update(data=data):
+                rows.create(state_id=self._pk, name=name, data=data)
+
+
+class StepRow(collections.Mapping):
+    """
+    The encoded form of a step that's stored in a ``WizardStepState`` row.
+    *data* (the row's serialized data) is only deserialized once the step's
+    data is accessed, *files* is known upfront.
+    """
+    def __init__(self, deserialize, data, files):
+        self._deserialize = deserialize
+        self._attrs = None
+        self.data = data
+        self.files = files
+
+    def __getitem__(self, key):
+        if key == 'files':
+            return self.files
+        if self._attrs is None:
+            self._attrs = self._deserialize(self.data)
+        return self._attrs[key]
+
+    def __iter__(self):
+        return iter(('data', 'files'))
+
+    def __len__(self):
+        return 2
@@ -9,23 +9,32 @@ _DATA = {}
 class DummyStorage(Storage):
     """
     A dummy storage that stores all data in memory. Designed for testing. Not
-    thread safe.
+    thread safe, see ``MemoryStorage`` for a storage that is.
     """
     def __init__(self, *args, **kwargs):
         super(DummyStorage, self).__init__(*args, **kwargs)
         self._deleted = False
 
     def process_request(self, request):
-        self.decode(_DATA.setdefault(self.namespace, {})
-                         .setdefault(self.name, {'current_step': None,
-                                                 'steps': {}}))
+        self.decode(_DATA.get(self.namespace, {}).get(self.name) or
+                    {'current_step': None, 'steps': {}})
 
     def process_response(self, response):
-        if not self._deleted:
-            _DATA[self.namespace][self.name].update(self.encode())
+        if not self._deleted and self.modified:
+            if self.steps or self.current_step:
+                _DATA.setdefault(self.namespace, {})[self.name] = self.encode()
+            else:
+                self._remove()
+            self.commit()
 
     def delete(self):
-        del _DATA[self.namespace][self.name]
-        if _DATA[self.namespace] == {}:
-            del _DATA[self.namespace]
+        self._remove()
+        self.reset()
+        self.commit()
         self._deleted = True
+
+    def _remove(self):
+        wizards = _DATA.get(self.namespace, {})
+        wizards.pop(self.name, None)
+        if not wizards:
+            _DATA.pop(self.namespace, None)
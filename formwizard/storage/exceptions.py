@@ -1,4 +1,4 @@
-from django.core.exceptions import ImproperlyConfigured
+from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
 
 
 class MissingStorageModule(ImproperlyConfigured):
@@ -11,3 +11,15 @@ class MissingStorageClass(ImproperlyConfigured):
 
 class NoFileStorageConfigured(ImproperlyConfigured):
     pass
+
+
+class FileNotSaved(IOError):
+    pass
+
+
+class FileTooLarge(SuspiciousOperation):
+    pass
+
+
+class StateConflict(Exception):
+    pass
@@ -0,0 +1,276 @@
+from __future__ import absolute_import, unicode_literals
+from django.core.files.base import File
+from django.core.files.uploadedfile import UploadedFile
+from formwizard.storage.exceptions import FileNotSaved, FileTooLarge
+from io import BytesIO
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import posixpath
+import threading
+import time
+import uuid
+
+
+class LazyUploadedFile(UploadedFile):
+    """
+    An ``UploadedFile`` for a file that was previously saved to a file
+    storage.
+
+    The metadata (``name``, ``size``, ``content_type`` and ``charset``) is
+    available without touching the file storage, the file itself is only
+    opened once its contents are accessed. After ``close()`` the file is
+    reopened if it's accessed again.
+
+    :param file_storage: the file storage the file was saved to
+    :type  file_storage: ``django.core.files.storage.Storage`` object
+    :param          key: name of the file in *file_storage*
+    :type           key: ``unicode``
+    :param      pending: whether the file is being saved in the background,
+                         in which case opening it waits for up to *timeout*
+                         seconds (see ``settle()``)
+    :type       pending: ``bool``
+    :param   chunk_size: default size of the chunks yielded by ``chunks()``
+    :type    chunk_size: ``int``
+    """
+    def __init__(self, file_storage, key, pending=False, timeout=None,
+                 chunk_size=None, **kwargs):
+        self._file = None
+        if chunk_size:
+            self.DEFAULT_CHUNK_SIZE = chunk_size
+        self.file_storage = file_storage
+        # See ``Storage._decode_files()``
+        self._wizard_file_storage_key = key
+        self._wizard_file_pending = pending
+        self._timeout = timeout
+        super(LazyUploadedFile, self).__init__(**kwargs)
+
+    def _open(self, mode='rb'):
+        if self._wizard_file_pending:
+            settle(self.file_storage, self._wizard_file_storage_key,
+                   self.size, self._timeout)
+            self._wizard_file_pending = False
+        return self.file_storage.open(self._wizard_file_storage_key, mode)
+
+    def _get_file(self):
+        if self._file is None:
+            self._file = self._open()
+        return self._file
+
+    def _set_file(self, file):
+        self._file = file
+
+    file = property(_get_file, _set_file)
+
+    @property
+    def closed(self):
+        return self._file is None or self._file.closed
+
+    def open(self, mode=None):
+        if not self.closed:
+            self.seek(0)
+        else:
+            self._file = self._open(mode or 'rb')
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def chunks(self, chunk_size=None):
+        """
+        Yields the content of the file in chunks of at most *chunk_size*
+        bytes, reading directly from the file storage until the end of the
+        file (rather than trusting ``size``).
+        """
+        return _chunks(self, chunk_size or self.DEFAULT_CHUNK_SIZE)
+
+
+class SizeBudget(object):
+    """
+    The number of bytes that several files may take up between them while
+    they're streamed (possibly concurrently), out of a maximum of *limit*
+    bytes.
+    """
+    def __init__(self, remaining, limit):
+        self.remaining = remaining
+        self.limit = limit
+        self._lock = threading.Lock()
+
+    def spend(self, size):
+        """
+        Deducts *size* bytes, and raises ``FileTooLarge`` if that exceeds the
+        budget.
+        """
+        with self._lock:
+            self.remaining -= size
+            if self.remaining < 0:
+                raise FileTooLarge('The files exceed the maximum total size '
+                                   'of %d bytes' % self.limit)
+
+    def refund(self, size):
+        with self._lock:
+            self.remaining += size
+
+
+class StreamedFile(File):
+    """
+    Wraps an uploaded file so that it's read in chunks of *chunk_size* bytes
+    when it's saved to a file storage, and raises ``FileTooLarge`` as soon as
+    more than *limit* bytes have been read, or the bytes that have been read
+    exceed *budget* (a ``SizeBudget`` shared with other files).
+
+    The wrapper intentionally doesn't expose ``temporary_file_path()``, so
+    file storages always stream the content rather than moving the file.
+    """
+    def __init__(self, file, chunk_size, limit=None, budget=None):
+        super(StreamedFile, self).__init__(file, file.name)
+        self.chunk_size = chunk_size
+        self.limit = limit
+        self.budget = budget
+        self.bytes_read = 0
+
+    def read(self, *args):
+        data = self.file.read(*args)
+        self.bytes_read += len(data)
+        if self.limit is not None and self.bytes_read > self.limit:
+            raise FileTooLarge('"%s" exceeds the maximum size of %d bytes'
+                               % (self.name, self.limit))
+        if self.budget is not None:
+            self.budget.spend(len(data))
+        return data
+
+    def chunks(self, chunk_size=None):
+        if self.budget is not None:
+            self.budget.refund(self.bytes_read)  # read again from the start
+        self.bytes_read = 0
+        return _chunks(self, chunk_size or self.chunk_size)
+
+
+def _chunks(file, chunk_size):
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    while True:
+        data = file.read(chunk_size)
+        if not data:
+            break
+        yield data
+
+
+# -----------------------------------------------------------------------------
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(size):
+    """
+    Returns a process wide pool of *size* threads, used to save files.
+    """
+    with _pools_lock:
+        pool = _pools.get(size)
+        if pool is None:
+            pool = _pools[size] = ThreadPool(size)
+        return pool
+
+
+# Results of background saves and the time they were started, by key.
+# Successful saves are removed once they complete. Failed saves are kept so
+# that ``settle()`` raises the error, until it has done so, or for
+# ``FAILED_SAVE_TTL`` seconds.
+_pending = {}
+_pending_lock = threading.Lock()
+FAILED_SAVE_TTL = 24 * 60 * 60
+
+
+def save_async(pool, save, uploadedfile):
+    """
+    Saves *uploadedfile* in the background on *pool*.
+
+    :param save: callable that's given *uploadedfile* and the name to save it
+                 as, and returns the key it was saved as
+    :returns: the key the file will be saved as
+    """
+    key = posixpath.join(uuid.uuid4().hex, uploadedfile.name)
+    if hasattr(uploadedfile, 'temporary_file_path'):
+        # The temporary file is deleted when the upload is closed at the end
+        # of the request, so an independent handle is required.
+        uploadedfile = UploadedFile(open(uploadedfile.temporary_file_path(),
+                                         'rb'),
+                                    uploadedfile.name,
+                                    uploadedfile.content_type,
+                                    uploadedfile.size, uploadedfile.charset)
+    else:
+        # An upload that's kept in memory is closed at the end of the request
+        # as well, and read by the request in the meantime, so its content is
+        # copied.
+        position = uploadedfile.tell()
+        content = b''.join(uploadedfile.chunks())
+        uploadedfile.seek(position)
+        uploadedfile = UploadedFile(BytesIO(content), uploadedfile.name,
+                                    uploadedfile.content_type,
+                                    uploadedfile.size, uploadedfile.charset)
+
+    def saved(result):
+        with _pending_lock:
+            _pending.pop(key, None)
+
+    with _pending_lock:
+        _expire_failed_saves()
+        _pending[key] = (pool.apply_async(_save, (save, uploadedfile, key),
+                                          callback=saved),
+                         time.time())
+    return key
+
+
+def _expire_failed_saves():
+    # Results only become ready after the callback of a successful save ran,
+    # so ready results are failures. Called with ``_pending_lock`` held.
+    cutoff = time.time() - FAILED_SAVE_TTL
+    for key, (result, started_at) in _pending.items():
+        if started_at < cutoff and result.ready():
+            del _pending[key]
+
+
+def _save(save, uploadedfile, key):
+    try:
+        saved_as = save(uploadedfile, key)
+    finally:
+        uploadedfile.close()
+    if saved_as != key:
+        raise FileNotSaved('"%s" was saved as "%s"' % (key, saved_as))
+    return key
+
+
+def settle(file_storage, key, size, timeout):
+    """
+    Waits for a file that's being saved in the background to be completely
+    saved to *file_storage*, and raises ``FileNotSaved`` if saving it failed
+    or didn't finish within *timeout* seconds.
+
+    If the file is being saved by this process, this waits for the save to
+    finish. Otherwise, e.g. if the file was uploaded via another server, this
+    waits until the file storage holds *size* bytes for the file.
+    """
+    with _pending_lock:
+        entry = _pending.get(key)
+    if entry is not None:
+        try:
+            entry[0].get(timeout)
+        except TimeoutError:
+            raise FileNotSaved('Timed out waiting for "%s" to be saved' % key)
+        except Exception:
+            with _pending_lock:
+                _pending.pop(key, None)  # the error has been reported
+            raise
+        return
+    deadline = time.time() + (timeout or 0)
+    while True:
+        try:
+            if file_storage.size(key) >= size:
+                return
+        except EnvironmentError:
+            pass
+        if time.time() >= deadline:
+            raise FileNotSaved('Timed out waiting for "%s" to be saved' % key)
+        time.sleep(0.1)
@@ -0,0 +1,182 @@
+from __future__ import absolute_import, unicode_literals
+from collections import OrderedDict
+import sys
+import threading
+import time
+
+
+class LRUCache(object):
+    """
+    A thread-safe, bounded mapping that evicts the least recently used
+    entries once it holds more than *max_entries* entries, or the sizes given
+    to ``set()`` add up to more than *max_size*. Entries that haven't been
+    used for *ttl* seconds expire.
+
+    ``hits`` and ``misses`` count the lookups done via ``get()``,
+    ``evictions`` and ``expirations`` the entries that were dropped.
+    """
+    def __init__(self, max_entries=1000, max_size=None, ttl=None):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, size, used_at = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            now = time.time()
+            if self.ttl is not None and now - used_at > self.ttl:
+                self.size -= size
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # most recently used
+            self._entries[key] = (value, size, now)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            if self.max_size is not None and size > self.max_size:
+                self.evictions += 1  # would evict everything else
+                return
+            now = time.time()
+            self._entries[key] = (value, size, now)
+            self.size += size
+            # entries are ordered by when they were used, so expired ones
+            # are at the front
+            while self.ttl is not None:
+                _, (_, evicted, used_at) = next(self._entries.iteritems())
+                if now - used_at <= self.ttl:
+                    break
+                self._entries.popitem(last=False)
+                self.size -= evicted
+                self.expirations += 1
+            while (len(self._entries) > self.max_entries
+                   or self.max_size is not None and self.size > self.max_size):
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self):
+        """
+        Returns a ``dict`` of the number of ``entries``, their combined
+        ``size``, and the ``hits``, ``misses``, ``evictions`` and
+        ``expirations`` so far.
+        """
+        with self._lock:
+            return {'entries': len(self._entries), 'size': self.size,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions,
+                    'expirations': self.expirations}
+
+
+class StripedLRUCache(object):
+    """
+    An ``LRUCache`` split into *stripes* parts that are locked independently,
+    so that threads using different keys rarely wait for each other. The
+    limits are divided among the stripes, each evicts its own least recently
+    used entries.
+    """
+    def __init__(self, stripes=16, max_entries=1000, max_size=None,
+                 ttl=None):
+        self._stripes = [
+                LRUCache(max(1, max_entries // stripes),
+                         None if max_size is None else max_size // stripes,
+                         ttl)
+                for _ in xrange(stripes)]
+
+    def __len__(self):
+        return sum(len(stripe) for stripe in self._stripes)
+
+    def _stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def get(self, key, default=None):
+        return self._stripe(key).get(key, default)
+
+    def set(self, key, value, size=0):
+        self._stripe(key).set(key, value, size)
+
+    def delete(self, key):
+        self._stripe(key).delete(key)
+
+    def clear(self):
+        for stripe in self._stripes:
+            stripe.clear()
+
+    def stats(self):
+        """
+        Returns the sums of the stripes' ``LRUCache.stats()``.
+        """
+        totals = {}
+        for stripe in self._stripes:
+            for name, value in stripe.stats().iteritems():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+class FrozenDict(dict):
+    """
+    A ``dict`` that can't be modified. Use ``freeze()`` to create one.
+    """
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('%s is immutable' % self.__class__.__name__)
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = \
+        update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self), ))
+
+
+def freeze(obj):
+    """
+    Returns a deeply immutable copy of *obj*: ``dict`` objects are converted
+    to ``FrozenDict``, and ``list`` objects to ``tuple``.
+    """
+    if isinstance(obj, dict):
+        return FrozenDict((key, freeze(value))
+                          for key, value in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return tuple(freeze(value) for value in obj)
+    return obj
+
+
+def sizeof(obj):
+    """
+    Returns an estimate of the memory (in bytes) taken up by *obj*, including
+    the ``dict``, ``list`` and ``tuple`` objects it contains.
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(sizeof(key) + sizeof(value)
+                    for key, value in obj.iteritems())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(sizeof(value) for value in obj)
+    return size
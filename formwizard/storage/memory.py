@@ -0,0 +1,70 @@
+from __future__ import absolute_import, unicode_literals
+from formwizard.storage.cache import CacheStorage
+from formwizard.storage.lru import freeze, sizeof, StripedLRUCache
+import threading
+
+
+class MemoryCache(StripedLRUCache):
+    """
+    A ``StripedLRUCache`` with the interface of Django's caches that
+    ``CacheStorage`` uses. The size of each value is estimated from the
+    memory its objects take up.
+    """
+    def set(self, key, value, timeout=None):
+        super(MemoryCache, self).set(key, value, sizeof(value))
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_memory_cache(stripes, max_entries, max_size, ttl):
+    """
+    Returns a process wide ``MemoryCache`` with the given limits.
+    """
+    args = (stripes, max_entries, max_size, ttl)
+    with _caches_lock:
+        cache = _caches.get(args)
+        if cache is None:
+            cache = _caches[args] = MemoryCache(*args)
+        return cache
+
+
+class MemoryStorage(CacheStorage):
+    """
+    A storage that keeps the state in the memory of the process, scoped like
+    ``CacheStorage``. Unlike ``DummyStorage`` it's thread-safe and bounded,
+    but states are still lost when the process exits, and aren't shared
+    between processes.
+
+    States are kept in a ``MemoryCache`` of at most ``max_entries`` states
+    and ``max_size`` bytes, split into ``stripes`` independently locked
+    parts. The least recently used states are evicted when it's full, and
+    states that haven't been used for ``timeout`` seconds expire. The
+    counts of evictions and expirations are available via
+    ``get_cache().stats()``.
+
+    States are stored as deeply immutable copies (see ``freeze()``), rather
+    than serialized, unless ``serializer`` or ``compress_threshold`` is
+    specified.
+    """
+    max_entries = 10000
+    max_size = 64 * 2 ** 20
+    stripes = 16
+    timeout = 60 * 60
+
+    @classmethod
+    def get_cache(cls):
+        """
+        Returns the ``MemoryCache`` the states are kept in.
+        """
+        return get_memory_cache(cls.stripes, cls.max_entries, cls.max_size,
+                                cls.timeout)
+
+    def _cache(self):
+        return self.get_cache()
+
+    def _dumps(self, value):
+        if self.serializer is None and self.compress_threshold is None:
+            return freeze(value)
+        return self.serialize(value)
@@ -0,0 +1,279 @@
+"""
+Serializers convert the encoded wizard state (see ``Storage.encode()``) to a
+byte string and back.
+
+The first byte of a serialized state is the *tag* of the serializer that
+produced it, which makes the format self-describing: ``loads()`` can
+deserialize a state regardless of which serializer is currently configured.
+JSON uses ``{`` as its tag, so plain JSON written by older releases is
+recognised too.
+
+Serialized states can additionally be compressed, in which case they're
+marked with the ``COMPRESSED`` tag.
+"""
+from __future__ import absolute_import, unicode_literals
+import base64
+import json
+import struct
+import zlib
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+class Serializer(object):
+    """
+    Base class for all serializers.
+
+    Subclasses must define a unique single byte ``tag`` and ensure that the
+    output of ``dumps()`` starts with it.
+    """
+    tag = None
+
+    def dumps(self, obj):
+        """
+        Returns *obj* serialized as a byte string.
+        """
+        raise NotImplementedError
+
+    def loads(self, data):
+        """
+        Performs the reverse operation to ``dumps()``.
+        """
+        raise NotImplementedError
+
+
+class JSONSerializer(Serializer):
+    """
+    Serializes to compact JSON using the standard library.
+    """
+    tag = b'{'
+    # explicitly specifying the separators removes extraneous JSON whitespace
+    encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def dumps(self, obj):
+        return self.encoder.encode(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class FastJSONSerializer(JSONSerializer):
+    """
+    Serializes to JSON using ``ujson`` if it's installed, otherwise falls back
+    to the standard library. The output is interchangeable with
+    ``JSONSerializer``.
+    """
+    def dumps(self, obj):
+        if ujson is None:
+            return super(FastJSONSerializer, self).dumps(obj)
+        return ujson.dumps(_plain(obj), ensure_ascii=True)
+
+    def loads(self, data):
+        if ujson is None:
+            return super(FastJSONSerializer, self).loads(data)
+        return ujson.loads(data)
+
+
+def _plain(obj):
+    """
+    Converts ``dict`` subclasses (e.g. ``QueryDict``) to a plain ``dict`` via
+    ``iteritems()``, which is what ``json`` does, but ``ujson`` doesn't.
+    """
+    if isinstance(obj, dict):
+        return dict((key, _plain(value)) for key, value in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_plain(value) for value in obj]
+    return obj
+
+
+class BinarySerializer(Serializer):
+    """
+    A compact binary format.
+
+    Each value is a type byte followed by its content. Lengths and integers
+    are variable length, and strings used as ``dict`` keys are interned, so
+    keys that repeat throughout the state (e.g. ``data``, ``files``,
+    ``name``) are written once and thereafter referred to by index.
+    """
+    tag = b'\x01'
+
+    def dumps(self, obj):
+        chunks = [self.tag]
+        self._write(obj, chunks.append, {})
+        return b''.join(chunks)
+
+    def _write(self, value, write, interned):
+        if value is None:
+            write(b'N')
+        elif value is True:
+            write(b'T')
+        elif value is False:
+            write(b'F')
+        elif isinstance(value, (int, long)):
+            write(b'i')
+            write(_varint(value * 2 if value >= 0 else -value * 2 - 1))
+        elif isinstance(value, float):
+            write(b'f')
+            write(struct.pack(b'>d', value))
+        elif isinstance(value, basestring):
+            write(b's')
+            self._write_string(value, write)
+        elif isinstance(value, dict):
+            write(b'd')
+            write(_varint(len(value)))
+            for key, item in value.iteritems():
+                index = interned.get(key)
+                if index is None:
+                    interned[key] = len(interned)
+                    write(b'k')
+                    self._write_string(key, write)
+                else:
+                    write(b'r')
+                    write(_varint(index))
+                self._write(item, write, interned)
+        elif isinstance(value, (list, tuple)):
+            write(b'l')
+            write(_varint(len(value)))
+            for item in value:
+                self._write(item, write, interned)
+        else:
+            raise TypeError('%r is not serializable' % (value, ))
+
+    def _write_string(self, value, write):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        write(_varint(len(value)))
+        write(value)
+
+    def loads(self, data):
+        value, pos = self._read(data, 1, [])
+        if pos != len(data):
+            raise ValueError('Extra data after position %d' % pos)
+        return value
+
+    def _read(self, data, pos, interned):
+        kind, pos = data[pos], pos + 1
+        if kind == b'N':
+            return None, pos
+        elif kind == b'T':
+            return True, pos
+        elif kind == b'F':
+            return False, pos
+        elif kind == b'i':
+            value, pos = _read_varint(data, pos)
+            return (value >> 1 if not value & 1 else -((value + 1) >> 1)), pos
+        elif kind == b'f':
+            return struct.unpack(b'>d', data[pos:pos + 8])[0], pos + 8
+        elif kind == b's':
+            return _read_string(data, pos)
+        elif kind == b'd':
+            length, pos = _read_varint(data, pos)
+            value = {}
+            for _ in xrange(length):
+                kind, pos = data[pos], pos + 1
+                if kind == b'k':
+                    key, pos = _read_string(data, pos)
+                    interned.append(key)
+                elif kind == b'r':
+                    index, pos = _read_varint(data, pos)
+                    key = interned[index]
+                else:
+                    raise ValueError('Expected key at position %d' % pos)
+                value[key], pos = self._read(data, pos, interned)
+            return value, pos
+        elif kind == b'l':
+            length, pos = _read_varint(data, pos)
+            value = []
+            for _ in xrange(length):
+                item, pos = self._read(data, pos, interned)
+                value.append(item)
+            return value, pos
+        raise ValueError('Unknown type %r at position %d' % (kind, pos - 1))
+
+
+def _varint(value):
+    result = bytearray()
+    while value > 0x7f:
+        result.append(value & 0x7f | 0x80)
+        value >>= 7
+    result.append(value)
+    return bytes(result)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+
+def _read_string(data, pos):
+    length, pos = _read_varint(data, pos)
+    end = pos + length
+    return data[pos:end].decode('utf-8'), end
+
+
+# -----------------------------------------------------------------------------
+
+
+COMPRESSED = b'z'
+
+registry = {}
+
+
+def register(serializer):
+    """
+    Makes *serializer* available to ``loads()``.
+    """
+    registry[serializer.tag] = serializer
+
+
+register(FastJSONSerializer() if ujson else JSONSerializer())
+register(BinarySerializer())
+
+
+def dumps(obj, serializer, compress_threshold=None, compress_level=6):
+    """
+    Serializes *obj* using *serializer* and returns ASCII text that's safe to
+    use in cookies and text columns. JSON is returned as-is, anything else is
+    base64 encoded.
+
+    If *compress_threshold* is given, serialized data of at least that many
+    bytes is compressed with ``zlib`` (as long as that makes the returned
+    text shorter, compressed data is base64 encoded as well).
+    """
+    data = serializer.dumps(obj)
+    text = _encode(data)
+    if compress_threshold is not None and len(data) >= compress_threshold:
+        compressed = _encode(COMPRESSED + zlib.compress(data, compress_level))
+        if len(compressed) < len(text):
+            text = compressed
+    return text
+
+
+def _encode(data):
+    if data[:1] != JSONSerializer.tag:
+        data = base64.urlsafe_b64encode(data)
+    return data
+
+
+def loads(data):
+    """
+    Performs the reverse operation to ``dumps()``. The serializer is chosen
+    based on the tag of *data*.
+    """
+    if data[:1] != JSONSerializer.tag:
+        data = base64.urlsafe_b64decode(str(data))
+    if data[:1] == COMPRESSED:
+        data = zlib.decompress(data[1:])
+    try:
+        serializer = registry[data[:1]]
+    except KeyError:
+        raise ValueError('Unknown serialization format %r' % data[:1])
+    return serializer.loads(data)
@@ -1,36 +1,184 @@
 from formwizard.storage import Storage
 from django.core.exceptions import ImproperlyConfigured
+import time
+
+
+# Session key of a ``dict`` mapping the key of each wizard in the session to
+# the time its state was last written, see ``purge_wizards()``.
+TIMESTAMPS_KEY = 'formwizard.timestamps'
+
+
+def purge_wizards(session, ttl):
+    """
+    Removes the state of wizards that haven't been written to *session* for
+    *ttl* seconds.
+
+    :returns: the keys of the wizards that were removed
+    """
+    timestamps = session.get(TIMESTAMPS_KEY)
+    if not timestamps:
+        return []
+    cutoff = time.time() - ttl
+    stale = [key for key, timestamp in timestamps.iteritems()
+             if timestamp < cutoff]
+    for key in stale:
+        session.pop(key, None)
+        prefix = key + b'|step|'
+        for name in [name for name in session.keys()
+                     if name.startswith(prefix)]:
+            del session[name]
+        del timestamps[key]
+    if stale:
+        if timestamps:
+            session[TIMESTAMPS_KEY] = timestamps
+        else:
+            del session[TIMESTAMPS_KEY]
+    return stale
 
 
 class SessionStorage(Storage):
     """
     A storage backend for form wizards that stores data into the user's
     session.
+
+    By default the state is stored as a ``dict`` and left to the session
+    serializer. If ``serializer`` or ``compress_threshold`` is specified, it's
+    stored serialized instead.
+
+    With ``per_step_keys``, each step is stored under a session key of its
+    own (``<key>|step|<step name>``), and the ``<key>`` entry is an index
+    holding the current step and the names of the steps. Only the entries
+    that changed are written, and once the wizard is reset (e.g. after
+    ``done()``) all of its entries are removed from the session.
+
+    Once a wizard is reset its entries are removed from the session. The
+    entries of wizards that are abandoned can be removed with
+    ``purge_wizards()``, which storages call on each request if
+    ``purge_ttl`` is set.
+
+    A version counter is stored with the state (in the index, with
+    ``per_step_keys``). If ``on_conflict`` is set, the wizard's entries are
+    read back from the session backend before they're written, to detect
+    whether a concurrent request wrote them in the meantime. This costs an
+    extra read of the session, and the session middleware saves the session
+    as a whole, so it narrows rather than closes the window for lost
+    writes. It's disabled by default.
     """
+    serializer = None
+    per_step_keys = False
+    purge_ttl = None
+    on_conflict = None
+
     def __init__(self, *args, **kwargs):
         super(SessionStorage, self).__init__(*args, **kwargs)
         self.key = ('%s|%s' % (self.namespace, self.name)).encode('utf-8')
         self._deleted = False  # delete requested?
+        self._index = None
+        self._session_steps = set()
+        self._version = 0
 
     def process_request(self, request):
         if not hasattr(request, 'session'):
             raise ImproperlyConfigured("Session middleware must be enabled to "
                                        "use %s" % self.__class__.__name__)
         self._session = request.session
-        data = self._session.get(self.key)
-        if data is None:
-            data = {'current_step': None, 'steps': {}}
+        if self.purge_ttl is not None:
+            purge_wizards(self._session, self.purge_ttl)
+        data, self._version, self._index = self._read(self._session)
+        if self._index is not None:
+            self._session_steps = set(data['steps'])
         self.decode(data)
 
     def process_response(self, response):
-        if not self._deleted:
-            self._session.setdefault(self.key, {}).update(self.encode())
-            self._session.modified = True
+        if not self._deleted and self.modified:
+            if not (self.steps or self.current_step):
+                self._remove()
+            else:
+                encoded = self.encode()
+                rewrite = False
+                if self.on_conflict is not None:
+                    stored = type(self._session)(self._session.session_key)
+                    theirs, version, _ = self._read(stored)
+                    if version != self._version:
+                        encoded = self.resolve_conflict(encoded, theirs)
+                        self._version = version
+                        rewrite = True
+                self._version += 1
+                if self.per_step_keys:
+                    self._write_steps(encoded, rewrite)
+                else:
+                    self._remove_steps(self._session_steps)
+                    encoded['version'] = self._version
+                    self._session[self.key] = self._dumps(encoded)
+                timestamps = self._session.get(TIMESTAMPS_KEY, {})
+                timestamps[self.key] = int(time.time())
+                self._session[TIMESTAMPS_KEY] = timestamps
+            self.commit()
 
     def delete(self):
-        try:
-            del self._session[self.key]
-        except KeyError:
-            pass
+        self._remove()
         self.reset()
+        self.commit()
         self._deleted = True
+
+    def _read(self, session):
+        """
+        Reads the wizard's entries from *session*.
+
+        :returns: ``(state, version, index)``, *index* is ``None`` unless the
+                  steps are stored under keys of their own
+        """
+        data = session.get(self.key)
+        if data is None:
+            return {'current_step': None, 'steps': {}}, 0, None
+        data = self._loads(data)
+        version = data.get('version', 0)
+        if not isinstance(data['steps'], list):
+            return data, version, None
+        steps = {}
+        for name in data['steps']:
+            attrs = session.get(self._step_key(name))
+            if attrs is not None:
+                steps[name] = self._loads(attrs)
+        return ({'current_step': data['current_step'], 'steps': steps},
+                version, data)
+
+    def _step_key(self, name):
+        return ('%s|step|%s' % (self.key, name)).encode('utf-8')
+
+    def _remove(self):
+        """
+        Removes all entries of the wizard from the session.
+        """
+        self._session.pop(self.key, None)
+        self._remove_steps(self._session_steps)
+        timestamps = self._session.get(TIMESTAMPS_KEY)
+        if timestamps and self.key in timestamps:
+            del timestamps[self.key]
+            if timestamps:
+                self._session[TIMESTAMPS_KEY] = timestamps
+            else:
+                del self._session[TIMESTAMPS_KEY]
+
+    def _remove_steps(self, names):
+        for name in names:
+            self._session.pop(self._step_key(name), None)
+
+    def _write_steps(self, encoded, rewrite=False):
+        """
+        Writes the entries of the steps in the encoded state that changed (or
+        all of them, if *rewrite* is ``True``), and the index.
+        """
+        # steps are all rewritten if they were replaced (e.g. by ``reset()``)
+        rewrite = rewrite or self._steps_modified or self._index is None
+        modified = set(step.name for step in self._decoded_steps()
+                       if step.modified)
+        for name, attrs in encoded['steps'].iteritems():
+            if rewrite or name in modified or name not in self._session_steps:
+                self._session[self._step_key(name)] = self._dumps(attrs)
+        self._remove_steps(self._session_steps.difference(encoded['steps']))
+        self._session[self.key] = self._dumps({
+            'current_step': encoded['current_step'],
+            'steps': sorted(encoded['steps']),
+            'version': self._version,
+        })
@@ -2,15 +2,19 @@ from __future__ import absolute_import, unicode_literals
 from django.core.exceptions import ImproperlyConfigured, ValidationError
 from django.core.urlresolvers import reverse, resolve, NoReverseMatch
 from django.forms import FileField
-from django.http import Http404
+from django.http import Http404, HttpResponse
 from django.shortcuts import redirect
+from django.template.defaultfilters import slugify
 from django.template.loader import get_template
 from django.template import RequestContext
 from django.views.generic import TemplateView
 from django.utils.datastructures import SortedDict
 from django.utils.decorators import classonlymethod
-from formwizard.storage import get_storage, Step
-from formwizard.storage.exceptions import NoFileStorageConfigured
+from formwizard.storage import (CookieStorage, DatabaseStorage, get_storage,
+                                Step)
+from formwizard.storage.exceptions import (FileTooLarge,
+                                           NoFileStorageConfigured,
+                                           StateConflict)
 from formwizard.forms import ManagementForm
 import operator
 
@@ -138,6 +142,13 @@ class WizardMixin(object):
     :type                storage: ``unicode``
     :param          file_storage: module path to one of Django's File Storage
     :type           file_storage: ``unicode``
+    :param      storage_database: alias of the database that a
+                                  ``DatabaseStorage`` stores the state in
+    :type       storage_database: ``unicode``
+    :param storage_read_database: alias of the database that a
+                                  ``DatabaseStorage`` reads the state from
+                                  (e.g. a replica)
+    :type  storage_read_database: ``unicode``
     :param                 steps: The pieces in the wizard. This is converted
                                   to a ``StepsManager`` object during
                                   ``as_view()``.
@@ -151,6 +162,8 @@ class WizardMixin(object):
     """
     storage = None
     file_storage = None
+    storage_database = None
+    storage_read_database = None
     forms = None
     steps = ()
     wizard_template = 'formwizard/wizard_form.html'
@@ -219,15 +232,39 @@ class WizardMixin(object):
             raise ImproperlyConfigured("%s.storage is not specified." % view)
         if isinstance(self.storage, basestring):
             storage_class = get_storage(self.storage)
-            return storage_class(name=self.name,
-                                 namespace=self.namespace,
-                                 file_storage=self.get_file_storage())
+            storage = storage_class(name=self.name,
+                                    namespace=self.namespace,
+                                    file_storage=self.get_file_storage())
+            if isinstance(storage, CookieStorage):
+                storage.cookie_path = self.get_cookie_path()
+            elif isinstance(storage, DatabaseStorage):
+                database, read_database = self.get_storage_databases()
+                if database is not None:
+                    storage.database = database
+                if read_database is not None:
+                    storage.read_database = read_database
+            return storage
         else:
             return self.storage
 
     def get_file_storage(self):
         return self.file_storage
 
+    def get_storage_databases(self):
+        """
+        Returns the aliases of the databases that a ``DatabaseStorage``
+        writes and reads the state to and from, as ``(database,
+        read_database)``. ``None`` keeps the storage's default.
+        """
+        return self.storage_database, self.storage_read_database
+
+    def get_cookie_path(self):
+        """
+        Returns the URL path that cookies of a ``CookieStorage`` are
+        restricted to, so that they're only sent to the wizard.
+        """
+        return self.request.path
+
     def dispatch(self, request, *args, **kwargs):
         """
         This method gets called by the routing engine. The first argument is
@@ -235,7 +272,10 @@ class WizardMixin(object):
         instance is stored in ``self.storage``.
 
         After processing the request using the ``dispatch`` method, the
-        response gets updated by the storage engine (for example add cookies).
+        response gets updated by the storage engine (for example add cookies),
+        and any files the storage opened are closed. If the storage can't
+        write the state because of a concurrent request, the response of
+        ``render_state_conflict`` is returned instead.
         """
         # View.dispatch() does this too, but we're doing some initialisation
         # before that's called, so we'll do this now.
@@ -246,8 +286,15 @@ class WizardMixin(object):
         self.steps = StepsManager(self)
         self.storage = self.get_storage()
         self.storage.process_request(request)
-        response = super(WizardMixin, self).dispatch(request, *args, **kwargs)
-        self.storage.process_response(response)
+        try:
+            response = super(WizardMixin, self).dispatch(request, *args,
+                                                         **kwargs)
+            try:
+                self.storage.process_response(response)
+            except StateConflict:
+                response = self.render_state_conflict()
+        finally:
+            self.storage.close()
         return response
 
     def get(self, request, *args, **kwargs):
@@ -339,7 +386,8 @@ class WizardMixin(object):
         instances = self.get_forms_instances(step)
         for i, form in enumerate(step.forms):
             kwargs = {
-                'data': step.data,
+                'data': (None if step.data is None
+                         else step.data.to_multivaluedict()),
                 'files': step.files,
                 'prefix': 'form-%s' % i,
                 'initial': initials[i],
@@ -358,16 +406,48 @@ class WizardMixin(object):
     def get_validated_step_forms(self, step, **kwargs):
         """
         Returns validated form objects for the given *step*.
+
+        Uploaded *files* (if given) are checked against the storage's limits
+        on file sizes, see ``get_file_size_validator()``.
         """
         forms = []
         kwargss = self.get_forms_kwargs(step)
+        validator = None
+        if kwargs.get('files'):
+            validator = self.get_file_size_validator(step, kwargs['files'])
         for form_kwargs, Form in zip(kwargss, step.forms):  # pylint: ignore=C0103
             form_kwargs.update(kwargs)
             form = Form(**form_kwargs)
+            if validator is not None:
+                for subform in getattr(form, 'forms', [form]):  # formset
+                    for field in subform.fields.itervalues():
+                        if isinstance(field, FileField):
+                            field.validators.append(validator)
             form.is_valid()  # trigger validation
             forms.append(form)
         return forms
 
+    def get_file_size_validator(self, step, files):
+        """
+        Returns a validator for the file fields of the forms of *step*, which
+        turns uploads that exceed the storage's limits (see
+        ``Storage.check_file_sizes()``) into form errors. *files* are the
+        uploaded files (e.g. ``request.FILES``).
+        """
+        if hasattr(files, 'lists'):
+            uploadedfiles = [uploadedfile for key, values in files.lists()
+                             for uploadedfile in values]
+        else:
+            uploadedfiles = files.values()
+
+        def validate(uploadedfile):
+            try:
+                self.storage.check_file_sizes([uploadedfile])
+                self.storage.check_file_sizes(uploadedfiles, step)
+            except FileTooLarge as e:
+                raise ValidationError(unicode(e))
+        return validate
+
     def get_context_data(self, forms, **kwargs):
         """
         Returns the template context for a step. You can overwrite this method
@@ -466,6 +546,17 @@ class WizardMixin(object):
         self.storage.current_step = step
         return self.render()
 
+    def render_state_conflict(self):
+        """
+        Gets called when the state was changed by a concurrent request (e.g.
+        in another tab) and the storage refused to write it (see
+        ``Storage.on_conflict``). By default, a ``409 Conflict`` response is
+        returned, so that the client can retry.
+        """
+        return HttpResponse('The wizard was changed by another request, '
+                            'please try again.', status=409,
+                            content_type='text/plain')
+
     def render_next_step(self):
         """
         When using the NamedUrlFormWizard, we have to redirect to update the
@@ -545,10 +636,28 @@ class NamedUrlWizardMixin(WizardMixin):  # pylint: ignore=W0223
             return reverse(match.func, args=match.args, kwargs=kwargs,
                            current_app=match.app_name)
 
+    def get_cookie_path(self):
+        """
+        Steps have URLs of their own, so cookies are restricted to the path
+        that all of them (and the URL of the wizard itself) have in common.
+        """
+        urls = [self.get_step_url(slug=slugify(name))
+                for name in self.get_forms()]
+        urls.append(self.get_step_url(slug=self.wizard_done_step_slug))
+        urls.append(self.request.path)
+        common = []
+        for segments in zip(*[url.split('/') for url in urls]):
+            if len(set(segments)) > 1:
+                break
+            common.append(segments[0])
+        return '/'.join(common) or '/'
+
     def get_storage(self):
         wizard = self
 
         class NamedUrlStep(Step):
+            __slots__ = ()
+
             @property
             def url(self):
                 return wizard.get_step_url(slug=self.slug)
@@ -569,7 +678,7 @@ class NamedUrlWizardMixin(WizardMixin):  # pylint: ignore=W0223
         # TODO: clean-up this, does it need to go in WizardMixin?
         for step in self.steps:
             if step.data is None:
-                step.data = {}
+                data = {}
                 # if it's a formset, we need to create a plain management form
                 # to use as the step data, otherwise we'll get "ManagementForm
                 # data is missing or has been tampered with" error
@@ -578,7 +687,8 @@ class NamedUrlWizardMixin(WizardMixin):  # pylint: ignore=W0223
                     if hasattr(form, "form"):  # formset
                         management_form = validated_step_forms[i].management_form
                         for key, value in management_form.initial.iteritems():
-                            step.data[management_form.add_prefix(key)] = value
+                            data[management_form.add_prefix(key)] = value
+                step.data = data
         # Make sure we're on the right page.
         if self.kwargs.get('slug') != self.wizard_done_step_slug:
             return redirect(self.get_step_url(slug=self.wizard_done_step_slug))
@@ -1,8 +1,16 @@
+import os
+import tempfile
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': ':memory:',
-    }
+    },
+    # a separate database, which tests fill to act as a (lagging) replica
+    'replica': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    },
 }
 
 INSTALLED_APPS = [
@@ -13,6 +21,17 @@ INSTALLED_APPS = [
     'formwizard',
 ]
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'files': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.path.join(tempfile.gettempdir(),
+                                 'formwizard-tests-cache'),
+    },
+}
+
 SECRET_KEY = 'abcdefghiljklmnopqrstuvwxyz'
 
 ROOT_URLCONF = 'tests.app.urls'
@@ -8,6 +8,9 @@ except ImportError:
 wizard_patterns = patterns('',
     url(r'^session/$', wizard.SessionContactWizard.as_view(), name='session'),
     url(r'^cookie/$',  wizard.CookieContactWizard.as_view(),  name='cookie'),
+    url(r'^perstepcookie/$', wizard.PerStepCookieContactWizard.as_view(),
+        name='perstepcookie'),
+    url(r'^cache/$',   wizard.CacheContactWizard.as_view(),   name='cache'),
 )
 
 namedurlwizard_patterns = patterns('',
@@ -39,3 +39,11 @@ class CookieContactWizard(ContactWizard):
         ('Step 3', Page3),
         ('Step 4', Page4),
     )
+
+
+class PerStepCookieContactWizard(CookieContactWizard):
+    storage = 'formwizard.storage.PerStepCookieStorage'
+
+
+class CacheContactWizard(SessionContactWizard):
+    storage = 'formwizard.storage.CacheStorage'
@@ -246,5 +246,12 @@ class CookieTests(NamedUrlWizardTests):
     url_name = 'namedurlwizard:cookie'
     prefix = 'tests.app.views.namedurlwizard.CookieContactWizard|default-'
 
+    @test
+    def cookie_should_be_restricted_to_wizard_path(self):
+        url = reverse(self.url_name, kwargs={'slug': 'step-1'})
+        response = self.client.post(url, self.datas[0])
+        key = 'tests.app.views.namedurlwizard.CookieContactWizard|default'
+        assert response.cookies[key]['path'] == '/namedurlwizard/cookie'
+
 
 tests = Tests([SessionTests(), CookieTests()])
@@ -4,22 +4,46 @@ from attest import assert_hook, Assert, Tests  # pylint: ignore=W0611
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured, SuspiciousOperation
 from django.core.files.storage import FileSystemStorage
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.core.files.uploadedfile import (InMemoryUploadedFile,
+                                            SimpleUploadedFile)
 from django.contrib.auth.models import AnonymousUser, User
 from django.contrib.sessions.middleware import SessionMiddleware
 from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import get_cache
+from Cookie import SimpleCookie
 from django import forms
-from django.http import HttpResponse
+from django.http import HttpResponse, QueryDict
 from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils.http import int_to_base36
 from django_attest import TestContext
-from formwizard.models import WizardState
-from formwizard.storage import (CookieStorage, DatabaseStorage, DummyStorage,
-                                get_storage, MissingStorageClass,
-                                MissingStorageModule, SessionStorage, Step,
-                                Storage)
+from formwizard.models import WizardFile, WizardState, WizardStepState
+from formwizard.storage import dummy, files, serializers
+from formwizard.storage.db import WRITTEN_AT_KEY
+from formwizard.storage.session import purge_wizards, TIMESTAMPS_KEY
+from formwizard.storage.lru import freeze, LRUCache, StripedLRUCache
+from formwizard.storage import (CacheStorage, CookieStorage, DatabaseStorage,
+                                DummyStorage, MemoryStorage,
+                                FileTooLarge, get_storage, LazySteps,
+                                MissingStorageClass, MissingStorageModule,
+                                PerStepCookieStorage, PerStepDatabaseStorage,
+                                SessionStorage,
+                                StateConflict, Step, StepData, Storage)
 from formwizard.views import WizardView
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.db import connection
+from django.db.models import F
+from django.core.management import call_command
+import base64
+import json
+import pickle
+import random
 import shutil
 import tempfile
+import threading
+import time
+import zlib
 
 
 factory = RequestFactory()
@@ -102,6 +126,461 @@ def should_encode_and_decode_properly(temp):
     assert actual == expected
 
 
+@core.test
+def decoded_files_should_be_opened_lazily(temp):
+    file_storage = FileSystemStorage(location=temp)
+    storage = Storage('name', 'namespace', file_storage)
+    with open(__file__, 'rb') as handle:
+        expected = handle.read()
+    storage['step1'].files = {
+        'file1': InMemoryUploadedFile(file=open(__file__, 'rb'),
+                                      field_name='file1', name='filename',
+                                      content_type='text/plain',
+                                      size=len(expected), charset='utf-8')}
+
+    restored = Storage('name', 'namespace', file_storage)
+    restored.decode(storage.encode())
+    uploaded_file = restored['step1'].files['file1']
+    assert uploaded_file.closed
+    assert uploaded_file.name == 'filename'
+    assert uploaded_file.size == len(expected)
+    assert uploaded_file.content_type == 'text/plain'
+    assert uploaded_file.charset == 'utf-8'
+    assert uploaded_file.closed
+
+    actual = uploaded_file.read()
+    assert actual == expected
+    assert not uploaded_file.closed
+    handle = uploaded_file.file
+    restored.close()
+    assert uploaded_file.closed
+    assert handle.closed
+
+    # reopened on demand
+    actual = ''.join(uploaded_file.chunks())
+    assert actual == expected
+    uploaded_file.close()
+
+
+@core.test
+def step_data_should_behave_like_a_read_only_querydict():
+    data = StepData(QueryDict('a=1&a=2&b=3'))
+    assert data['a'] == '2'
+    assert data.getlist('a') == ['1', '2']
+    assert data.get('b') == '3'
+    assert data.getlist('b') == ['3']
+    assert data.get('c') is None
+    assert data.getlist('c') == []
+    assert sorted(data) == ['a', 'b']
+    assert len(data) == 2
+    assert data == {'a': '2', 'b': '3'}
+    assert data == StepData({'a': ['1', '2'], 'b': '3'})
+    assert data != StepData({'a': '2', 'b': '3'})
+    assert data.to_dict() == {'a': ['1', '2'], 'b': '3'}
+    assert data.to_multivaluedict().getlist('a') == ['1', '2']
+    assert pickle.loads(pickle.dumps(data)) == data
+    with Assert.raises(TypeError):
+        data['a'] = '3'
+    with Assert.raises(AttributeError):
+        data.foo = 'bar'
+
+    # keys without values, like QueryDict
+    empty, querydict = StepData({'a': []}), QueryDict('').copy()
+    querydict.setlist('a', [])
+    assert empty['a'] == querydict['a'] == []
+    assert empty.get('a', 'default') == querydict.get('a', 'default')
+    assert empty.getlist('a') == querydict.getlist('a') == []
+    assert 'a' in empty
+
+    # keys are shared
+    other = StepData({'a': '1'})
+    assert [k for k in other][0] is [k for k in data if k == 'a'][0]
+
+
+@core.test
+def steps_should_keep_multiple_values_across_encode_and_decode():
+    storage = Storage('name', 'namespace')
+    step = storage['step1']
+    step.data = QueryDict('a=1&a=2&b=3')
+    assert step.modified
+    restored = Storage('name', 'namespace')
+    restored.decode(storage.encode())
+    assert restored['step1'].data.getlist('a') == ['1', '2']
+
+    # assigning equal data isn't a modification
+    restored['step1'].data = QueryDict('a=1&a=2&b=3')
+    assert not restored.modified
+    assert not hasattr(restored['step1'], '__dict__')
+
+
+@core.test
+def should_store_identical_files_once_per_wizard(temp):
+    class DedupStorage(Storage):
+        file_dedup = 'wizard'
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = DedupStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'content')}
+    storage['step2'].files = {'b': SimpleUploadedFile('b.txt', b'content'),
+                              'c': SimpleUploadedFile('c.txt', b'other')}
+    encoded = storage.encode()
+    a = encoded['steps']['step1']['files']['a']
+    b = encoded['steps']['step2']['files']['b']
+    c = encoded['steps']['step2']['files']['c']
+    assert a['file_storage_key'] == b['file_storage_key']
+    assert a['digest'] == b['digest']
+    assert c['file_storage_key'] != b['file_storage_key']
+    assert b['name'] == 'b.txt'
+    assert len(file_storage.listdir('')[1]) == 2
+
+    # re-uploading after the state is restored reuses the stored file
+    restored = DedupStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    restored['step3'].files = {'d': SimpleUploadedFile('d.txt', b'other')}
+    encoded = restored.encode()
+    d = encoded['steps']['step3']['files']['d']
+    assert d['file_storage_key'] == c['file_storage_key']
+    assert len(file_storage.listdir('')[1]) == 2
+
+
+@core.test
+def should_limit_file_sizes(temp):
+    class LimitedStorage(Storage):
+        file_chunk_size = 4
+        file_max_size = 10
+        file_max_total_size = 15
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = LimitedStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'x' * 11)}
+    with Assert.raises(FileTooLarge):
+        storage.encode()
+
+    # files that claim to be smaller than they are are caught while streaming
+    liar = SimpleUploadedFile('b.txt', b'x' * 11)
+    liar.size = 5
+    storage['step1'].files = {'b': liar}
+    with Assert.raises(FileTooLarge):
+        storage.encode()
+    assert file_storage.listdir('') == ([], [])
+
+    # ... including files that are each within the limit, but exceed the
+    # total between them
+    liars = {}
+    for name in ('b', 'c'):
+        liars[name] = SimpleUploadedFile('%s.txt' % name, b'x' * 9)
+        liars[name].size = 5
+    storage['step1'].files = liars
+    with Assert.raises(FileTooLarge):
+        storage.encode()
+    assert file_storage.listdir('') == ([], [])
+
+    # sizes are checked before files are read for deduplication
+    class DedupStorage(LimitedStorage):
+        file_dedup = 'wizard'
+
+        def _file_digest(self, uploadedfile):
+            digested.append(uploadedfile.name)
+            return super(DedupStorage, self)._file_digest(uploadedfile)
+
+    digested = []
+    storage = DedupStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'x' * 11)}
+    with Assert.raises(FileTooLarge):
+        storage.encode()
+    assert digested == []
+    storage['step1'].files = {'b': liar}
+    with Assert.raises(FileTooLarge):
+        storage.encode()
+    assert file_storage.listdir('') == ([], [])
+
+    # the total includes files stored for other steps
+    storage['step1'].files = {'c': SimpleUploadedFile('c.txt', b'x' * 10)}
+    encoded = storage.encode()
+    restored = LimitedStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    restored['step2'].files = {'d': SimpleUploadedFile('d.txt', b'x' * 6)}
+    with Assert.raises(FileTooLarge):
+        restored.encode()
+    restored['step2'].files = {'d': SimpleUploadedFile('d.txt', b'x' * 5)}
+    restored.encode()
+    assert len(file_storage.listdir('')[1]) == 2
+
+
+@core.test
+def wizard_views_should_report_files_that_are_too_large(temp):
+    class Step1(forms.Form):
+        a = forms.FileField()
+        b = forms.FileField(required=False)
+
+    class Step2(forms.Form):
+        c = forms.FileField()
+
+    class LimitedStorage(CookieStorage):
+        file_max_size = 10
+        file_max_total_size = 15
+
+    class LimitedWizardView(WizardView):
+        # pylint: ignore=W0223
+        steps = (("Step 1", Step1), ("Step 2", Step2))
+        template_name = 'simple.html'
+        file_storage = FileSystemStorage(location=temp)
+
+        def get_storage(self):
+            return LimitedStorage(self.get_name(), self.get_namespace(),
+                                  self.get_file_storage())
+
+        def get_context_data(self, forms, **kwargs):
+            rendered.append(forms[0])
+            return super(LimitedWizardView, self).get_context_data(forms,
+                                                                   **kwargs)
+
+        def done(self, forms):
+            return HttpResponse('done')
+
+    def post(step, cookies=(), **sizes):
+        data = {'mgmt-current_step': step}
+        for name, size in sizes.iteritems():
+            data['form-0-%s' % name] = SimpleUploadedFile('%s.txt' % name,
+                                                          b'x' * size)
+        request = factory.post('/', data)
+        request.COOKIES.update(cookies)
+        del rendered[:]
+        return LimitedWizardView.as_view()(request)
+
+    rendered = []
+    total = ['The files exceed the maximum total size of 15 bytes']
+    post('Step 1', a=11)
+    assert rendered[0].errors['a'] == [
+            '"a.txt" exceeds the maximum size of 10 bytes']
+    post('Step 1', a=8, b=8)
+    assert rendered[0].errors['a'] == rendered[0].errors['b'] == total
+    assert FileSystemStorage(location=temp).listdir('') == ([], [])
+
+    # the total includes the files of the other steps
+    response = post('Step 1', a=8)
+    assert isinstance(rendered[0], Step2)
+    cookies = [(key, cookie.value) for key, cookie in response.cookies.items()]
+    post('Step 2', cookies, c=8)
+    assert rendered[0].errors['c'] == total
+    response = post('Step 2', cookies, c=7)
+    assert response.content == b'done'
+
+
+
+@core.test
+def should_delete_orphaned_files(temp):
+    class CleanStorage(Storage):
+        delete_orphaned_files = True
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = CleanStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'a')}
+    storage['step2'].files = {'b': SimpleUploadedFile('b.txt', b'b')}
+    encoded = storage.encode()
+    storage.commit()
+    assert len(file_storage.listdir('')[1]) == 2
+
+    # replacing a file
+    restored = CleanStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    restored['step1'].files = {'a': SimpleUploadedFile('c.txt', b'c')}
+    encoded = restored.encode()
+    restored.commit()
+    assert sorted(file_storage.listdir('')[1]) == ['b.txt', 'c.txt']
+
+    # files that were saved but replaced before the state was written
+    restored['step1'].files = {'a': SimpleUploadedFile('d.txt', b'd')}
+    restored.encode()
+    restored['step1'].files = {'a': SimpleUploadedFile('e.txt', b'e')}
+    restored.encode()
+    restored.commit()
+    assert sorted(file_storage.listdir('')[1]) == ['b.txt', 'e.txt']
+
+    restored.reset()
+    restored.commit()
+    assert file_storage.listdir('') == ([], [])
+
+
+@core.test
+def decoded_files_should_be_read_in_chunks(temp):
+    class ChunkedStorage(Storage):
+        file_chunk_size = 4
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = ChunkedStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'0123456789')}
+    restored = ChunkedStorage('name', 'namespace', file_storage)
+    restored.decode(storage.encode())
+    chunks = list(restored['step1'].files['a'].chunks())
+    assert chunks == [b'0123', b'4567', b'89']
+
+
+@core.test
+def should_save_files_concurrently(temp):
+    class ConcurrentStorage(Storage):
+        file_save_workers = 4
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = ConcurrentStorage('name', 'namespace', file_storage)
+    storage['step1'].files = dict(
+        ('f%d' % i, SimpleUploadedFile('f%d.txt' % i, b'content %d' % i))
+        for i in range(8))
+    encoded = storage.encode()
+    assert len(file_storage.listdir('')[1]) == 8
+
+    restored = ConcurrentStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    content = restored['step1'].files['f5'].read()
+    assert content == b'content 5'
+
+    # errors raised while saving propagate
+    class BrokenStorage(ConcurrentStorage):
+        def _store_file(self, uploadedfile, name=None, **kwargs):
+            raise IOError('disk full')
+
+    storage = BrokenStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'a'),
+                              'b': SimpleUploadedFile('b.txt', b'b')}
+    with Assert.raises(IOError):
+        storage.encode()
+
+
+@core.test
+def should_save_files_in_background(temp):
+    class AsyncStorage(Storage):
+        file_save_async = True
+
+    file_storage = FileSystemStorage(location=temp)
+    storage = AsyncStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'content')}
+    encoded = storage.encode()
+    a = encoded['steps']['step1']['files']['a']
+    assert a['pending'] is True
+
+    restored = AsyncStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    content = restored['step1'].files['a'].read()
+    assert content == b'content'
+
+    # encoding the restored file keeps its key, without the pending marker
+    restored.steps['step1'].files = restored['step1'].files
+    again = restored.encode()['steps']['step1']['files']['a']
+    assert again['file_storage_key'] == a['file_storage_key']
+    assert 'pending' not in again
+
+    # uploads kept in memory are closed at the end of the request, possibly
+    # before they're saved
+    closed = threading.Event()
+
+    class SlowStorage(AsyncStorage):
+        def _store_file(self, uploadedfile, name=None, **kwargs):
+            closed.wait(5)
+            return super(SlowStorage, self)._store_file(uploadedfile, name,
+                                                        **kwargs)
+
+    uploadedfile = SimpleUploadedFile('b.txt', b'in memory')
+    storage = SlowStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'b': uploadedfile}
+    encoded = storage.encode()
+    uploadedfile.file.close()  # as ``request.close()`` does
+    closed.set()
+    restored = SlowStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    content = restored['step1'].files['b'].read()
+    assert content == b'in memory'
+
+    # a failed background save is raised when the file is opened
+    class BrokenStorage(AsyncStorage):
+        def _store_file(self, uploadedfile, name=None, **kwargs):
+            raise IOError('disk full')
+
+    storage = BrokenStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'content')}
+    encoded = storage.encode()
+    key = encoded['steps']['step1']['files']['a']['file_storage_key']
+    restored = BrokenStorage('name', 'namespace', file_storage)
+    restored.decode(encoded)
+    with Assert.raises(IOError):
+        restored['step1'].files['a'].read()
+    # ... and then forgotten
+    assert key not in files._pending
+
+    # failures that are never reported are forgotten eventually
+    storage = BrokenStorage('name', 'namespace', file_storage)
+    storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'content')}
+    encoded = storage.encode()
+    key = encoded['steps']['step1']['files']['a']['file_storage_key']
+    files._pending[key][0].wait()
+    ttl, files.FAILED_SAVE_TTL = files.FAILED_SAVE_TTL, -1
+    try:
+        storage['step2'].files = {'b': SimpleUploadedFile('b.txt', b'b')}
+        storage.encode()
+    finally:
+        files.FAILED_SAVE_TTL = ttl
+    assert key not in files._pending
+
+
+@core.test
+def lru_cache_should_evict_least_recently_used_entries():
+    cache = LRUCache(max_entries=2, max_size=10)
+    cache.set('a', 1, size=3)
+    cache.set('b', 2, size=3)
+    a = cache.get('a')
+    assert a == 1
+    cache.set('c', 3, size=3)  # evicts b
+    values = [cache.get(key) for key in 'abc']
+    assert values == [1, None, 3]
+    cache.set('d', 4, size=8)  # evicts a and c
+    assert len(cache) == 1
+    assert cache.size == 8
+    cache.set('e', 5, size=11)  # too large to be cached
+    e = cache.get('e')
+    assert e is None
+    assert (cache.hits, cache.misses) == (3, 2)
+    assert cache.evictions == 4  # b, a and c, and e
+
+
+@core.test
+def lru_cache_should_expire_idle_entries():
+    cache = LRUCache(max_entries=10, ttl=60)
+    for key in 'abc':
+        cache.set(key, key, size=1)
+    # pretend a and b haven't been used for a while
+    for key in 'ab':
+        value, size, used_at = cache._entries[key]
+        cache._entries[key] = (value, size, used_at - 120)
+    a = cache.get('a')
+    assert a is None
+    cache.set('d', 'd', size=1)  # drops b
+    stats = cache.stats()
+    assert stats == {'entries': 2, 'size': 2, 'hits': 0, 'misses': 1,
+                     'evictions': 0, 'expirations': 2}
+
+
+@core.test
+def striped_lru_cache_should_divide_limits_among_stripes():
+    cache = StripedLRUCache(stripes=4, max_entries=8)
+    for i in range(100):
+        cache.set(i, i)
+    assert len(cache) <= 8
+    stats = cache.stats()
+    assert stats['entries'] == len(cache)
+    assert stats['evictions'] == 100 - len(cache)
+
+
+@core.test
+def freeze_should_make_deeply_immutable_copies():
+    original = {'a': [1, {'b': 2}]}
+    frozen = freeze(original)
+    assert frozen == {'a': (1, {'b': 2})}
+    with Assert.raises(TypeError):
+        frozen['a'] = 1
+    with Assert.raises(TypeError):
+        frozen['a'][1].update(c=3)
+    assert pickle.loads(pickle.dumps(frozen)) == frozen
+
+
 @core.test
 def should_support_in_operator():
     storage = Storage('name', 'namespace')
@@ -114,6 +593,218 @@ def should_support_in_operator():
     assert 'some step' in restored
 
 
+@core.test
+def modified_should_track_changes():
+    storage = Storage('name', 'namespace')
+    storage.decode({'current_step': 'step1',
+                    'steps': {'step1': {'data': {'a': 'b'}, 'files': None}}})
+    assert not storage.modified
+
+    # merely accessing steps isn't a change
+    storage['step1']
+    storage['step2']
+    storage.current_step = storage['step1']
+    assert not storage.modified
+
+    storage.current_step = storage['step2']
+    assert storage.modified
+    storage.current_step = storage['step1']
+    assert not storage.modified
+
+    storage['step1'].data = {'a': 'c'}
+    assert storage.modified
+
+    storage.decode(storage.encode())
+    assert not storage.modified
+    storage.reset()
+    assert storage.modified
+
+
+@core.test
+def reset_of_blank_state_shouldnt_be_a_change():
+    storage = Storage('name', 'namespace')
+    storage.decode({'current_step': 'step1',
+                    'steps': {'step1': {'data': None, 'files': None}}})
+    storage.reset()
+    storage.current_step = storage['step1']
+    assert not storage.modified
+
+    storage.decode({'current_step': None,
+                    'steps': {'step1': {'data': None, 'files': None}}})
+    storage.reset()
+    assert not storage.modified
+
+
+@core.test
+def removing_steps_should_be_a_change():
+    storage = Storage('name', 'namespace')
+    storage.decode({'current_step': None,
+                    'steps': {'step1': {'data': {'a': 'b'}, 'files': None},
+                              'step2': {'data': None, 'files': None}}})
+    del storage.steps['step2']
+    assert storage.modified
+    assert storage.encode()['steps'].keys() == ['step1']
+
+
+@core.test
+def lazy_decode_should_only_decode_accessed_steps():
+    class LazyStorage(Storage):
+        lazy_decode = True
+
+    untouched = {'data': {'a': 'b'},
+                 'files': {'file1': {'file_storage_key': 'missing',
+                                     'name': 'missing', 'size': 1,
+                                     'content_type': 'text/plain',
+                                     'charset': None}}}
+    # no file storage, so decoding the files of step2 would fail
+    storage = LazyStorage('name', 'namespace')
+    storage.decode({'current_step': 'step1',
+                    'steps': {'step1': {'data': {'c': 'd'}, 'files': None},
+                              'step2': untouched}})
+    assert isinstance(storage.steps, LazySteps)
+    assert 'step2' in storage
+    assert len(storage.steps) == 2
+    assert storage.steps.pending == {'step2': untouched}
+
+    storage['step1'].data = {'c': 'e'}
+    assert storage.modified
+    encoded = storage.encode()
+    assert encoded['steps']['step1'] == {'data': {'c': 'e'}, 'files': None}
+    assert encoded['steps']['step2'] is untouched
+
+    storage.reset()
+    assert storage.encode() == {'current_step': None, 'steps': {}}
+
+
+serializer = Tests()
+
+STATE = {
+    'current_step': 'step2',
+    'steps': {
+        'step1': {
+            'data': {'form-0-name': 'Brad', 'form-0-age': '1',
+                     'form-0-bio': '\u2603' * 3},
+            'files': {'form-0-file': {'file_storage_key': 'a.txt',
+                                      'name': 'a.txt', 'size': 123,
+                                      'content_type': 'text/plain',
+                                      'charset': None}},
+        },
+        'step2': {'data': None, 'files': None},
+    }
+}
+
+
+@serializer.test
+def serializers_should_roundtrip():
+    for s in (serializers.JSONSerializer(), serializers.FastJSONSerializer(),
+              serializers.BinarySerializer()):
+        data = s.dumps(STATE)
+        assert data[:1] == s.tag
+        assert s.loads(data) == STATE
+        text = serializers.dumps(STATE, s)
+        assert text.decode('ascii')
+        assert serializers.loads(text) == STATE
+
+
+@serializer.test
+def binary_serializer_should_handle_all_types():
+    s = serializers.BinarySerializer()
+    value = {'a': [None, True, False, 0, -1, 2 ** 70, -2 ** 70, 1.5, 'x', ''],
+             'b': {'a': {'a': ()}}}
+    expected = dict(value, b={'a': {'a': []}})
+    assert s.loads(s.dumps(value)) == expected
+    with Assert.raises(TypeError):
+        s.dumps({'a': object()})
+
+
+@serializer.test
+def binary_serializer_should_be_smaller_than_json():
+    state = {'current_step': 'step1', 'steps': {}}
+    for i in range(10):
+        state['steps']['step%d' % i] = STATE['steps']['step1']
+    binary = serializers.BinarySerializer().dumps(state)
+    assert len(binary) < len(serializers.JSONSerializer().dumps(state))
+
+
+@serializer.test
+def loads_should_reject_unknown_formats():
+    with Assert.raises(ValueError):
+        serializers.loads(serializers.base64.urlsafe_b64encode(b'\xffabc'))
+
+
+@serializer.test
+def storages_should_decode_states_in_any_format():
+    class BinaryCookieStorage(CookieStorage):
+        serializer = serializers.BinarySerializer()
+
+    binary = BinaryCookieStorage('name', 'namespace')
+    binary['step1'].data = {'a': 'b'}
+    plain = CookieStorage('name', 'namespace')
+    plain.decode(binary.encode())
+    assert plain['step1'].data == {'a': 'b'}
+    binary.decode(plain.encode())
+    assert binary['step1'].data == {'a': 'b'}
+
+
+@serializer.test
+def should_compress_states_over_threshold():
+    s = serializers.JSONSerializer()
+    state = {'current_step': 'step1', 'steps': {}}
+    for i in range(20):
+        state['steps']['step%d' % i] = STATE['steps']['step1']
+
+    plain = serializers.dumps(state, s)
+    compressed = serializers.dumps(state, s, compress_threshold=len(plain))
+    assert len(compressed) < len(plain) / 2
+    assert serializers.loads(compressed) == state
+
+    # below the threshold data is left alone
+    assert serializers.dumps(state, s, compress_threshold=len(plain) + 1) == plain
+    # as is data that compression doesn't shrink
+    small = {'a': 1}
+    assert serializers.dumps(small, s, compress_threshold=0) == '{"a":1}'
+    # ... once it's base64 encoded, which JSON isn't
+    rand = random.Random(0)
+    noise = {'a': base64.b64encode(bytes(bytearray(rand.randrange(256)
+                                                   for i in range(1500))))}
+    plain = serializers.dumps(noise, s)
+    assert len(zlib.compress(plain)) < len(plain)
+    assert serializers.dumps(noise, s, compress_threshold=0) == plain
+
+
+@serializer.test
+def storages_should_compress_states():
+    class CompressedCookieStorage(CookieStorage):
+        compress_threshold = 100
+
+    class CompressedSessionStorage(SessionStorage):
+        compress_threshold = 100
+
+    storage = CompressedCookieStorage('name', 'namespace')
+    for i in range(20):
+        storage['step%d' % i].data = STATE['steps']['step1']['data']
+    plain = CookieStorage('name', 'namespace')
+    plain.steps = storage.steps
+    encoded = storage.encode()
+    assert len(encoded) < len(plain.encode()) / 2
+    restored = CookieStorage('name', 'namespace')
+    restored.decode(encoded)
+    assert restored.encode() == plain.encode()
+
+    middleware = SessionMiddleware()
+    request, response = factory.get('/'), HttpResponse('')
+    middleware.process_request(request)
+    storage = CompressedSessionStorage('name', 'namespace')
+    storage.process_request(request)
+    for i in range(20):
+        storage['step%d' % i].data = STATE['steps']['step1']['data']
+    storage.process_response(response)
+    assert isinstance(request.session[storage.key], basestring)
+    restored = SessionStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step19'].data == STATE['steps']['step1']['data']
+
+
 session = Tests()
 
 
@@ -182,6 +873,197 @@ def should_completely_remove_data_from_session_when_deleted():
     assert 'namespace|name' not in request.session
 
 
+@session.test
+def shouldnt_modify_session_when_state_unchanged():
+    middleware = SessionMiddleware()
+    request, response = factory.get('/'), HttpResponse('')
+    middleware.process_request(request)
+    storage = SessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(response)
+    assert request.session.modified
+    middleware.process_response(request, response)
+
+    request = factory.get('/')
+    request.COOKIES.update(((k, v.value)
+                            for k, v in response.cookies.iteritems()))
+    middleware.process_request(request)
+    storage = SessionStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+    assert not request.session.modified
+
+
+@session.test
+def should_store_serialized_state_when_serializer_specified():
+    class BinarySessionStorage(SessionStorage):
+        serializer = serializers.BinarySerializer()
+
+    middleware = SessionMiddleware()
+    request, response = factory.get('/'), HttpResponse('')
+    middleware.process_request(request)
+    storage = BinarySessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(response)
+    assert isinstance(request.session[storage.key], basestring)
+
+    storage = BinarySessionStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'blarg': 'bloog'}
+
+
+@session.test
+def should_store_steps_under_separate_keys():
+    class PerStepSessionStorage(SessionStorage):
+        per_step_keys = True
+
+    middleware = SessionMiddleware()
+    request = factory.get('/')
+    middleware.process_request(request)
+    storage = PerStepSessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'a': '1'}
+    storage['step2'].data = {'b': '2'}
+    storage.process_response(HttpResponse(''))
+    step1, step2 = storage._step_key('step1'), storage._step_key('step2')
+    assert request.session[storage.key]['steps'] == ['step1', 'step2']
+    assert request.session[step1]['data'] == {'a': '1'}
+
+    # only the modified step is written
+    stored = request.session[step1]
+    request.session.modified = False
+    storage = PerStepSessionStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': '1'}
+    storage['step2'].data = {'b': '3'}
+    storage.process_response(HttpResponse(''))
+    assert request.session.modified
+    assert request.session[step1] is stored
+    assert request.session[step2]['data'] == {'b': '3'}
+
+    # resetting removes all entries
+    storage = PerStepSessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.reset()
+    storage.process_response(HttpResponse(''))
+    for key in (storage.key, step1, step2):
+        assert key not in request.session
+
+
+@session.test
+def should_remove_state_from_session_when_reset():
+    middleware = SessionMiddleware()
+    request = factory.get('/')
+    middleware.process_request(request)
+    storage = SessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+    assert storage.key in request.session[TIMESTAMPS_KEY]
+
+    storage = SessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.reset()
+    storage.process_response(HttpResponse(''))
+    assert storage.key not in request.session
+    assert TIMESTAMPS_KEY not in request.session
+
+
+@session.test
+def should_purge_abandoned_wizards():
+    middleware = SessionMiddleware()
+    request = factory.get('/')
+    middleware.process_request(request)
+    for name in ('old', 'new'):
+        storage = SessionStorage(name, 'namespace')
+        storage.per_step_keys = name == 'old'
+        storage.process_request(request)
+        storage['step1'].data = {'blarg': 'bloog'}
+        storage.process_response(HttpResponse(''))
+    old = SessionStorage('old', 'namespace')
+    request.session[TIMESTAMPS_KEY][old.key] -= 120
+    purged = purge_wizards(request.session, 60)
+    assert purged == [old.key]
+    assert old.key not in request.session
+    assert old._step_key('step1') not in request.session
+    assert request.session[TIMESTAMPS_KEY].keys() == [b'namespace|new']
+
+    class PurgingSessionStorage(SessionStorage):
+        purge_ttl = 0
+
+    request.session[TIMESTAMPS_KEY][b'namespace|new'] -= 1
+    PurgingSessionStorage('other', 'namespace').process_request(request)
+    assert b'namespace|new' not in request.session
+
+
+@session.test
+def dummy_storage_should_replace_and_remove_state():
+    storage = DummyStorage('name', 'namespace')
+    storage.process_request(factory.get('/'))
+    assert 'name' not in dummy._DATA.get('namespace', {})
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+    assert dummy._DATA['namespace']['name']['steps'].keys() == ['step1']
+
+    storage = DummyStorage('name', 'namespace')
+    storage.process_request(factory.get('/'))
+    storage.reset()
+    storage.process_response(HttpResponse(''))
+    assert 'namespace' not in dummy._DATA
+
+
+@session.test
+def should_merge_concurrent_session_writes():
+    class CheckedSessionStorage(SessionStorage):
+        on_conflict = 'merge'
+
+    middleware = SessionMiddleware()
+    request = factory.get('/')
+    middleware.process_request(request)
+    storage = CheckedSessionStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'a': '1'}
+    storage.process_response(HttpResponse(''))
+    request.session.save()
+    session_key = request.session.session_key
+
+    # two requests read the same state, then each changes a different step
+    requests = []
+    for i in range(2):
+        request = factory.get('/')
+        request.session = SessionStore(session_key)
+        storage = CheckedSessionStorage('name', 'namespace')
+        storage.process_request(request)
+        requests.append((request, storage))
+    (first, first_storage), (second, second_storage) = requests
+    first_storage['step2'].data = {'b': '2'}
+    first_storage.process_response(HttpResponse(''))
+    first.session.save()
+    second_storage['step1'].data = {'a': '3'}
+    second_storage.process_response(HttpResponse(''))
+    second.session.save()
+
+    storage = CheckedSessionStorage('name', 'namespace')
+    request = factory.get('/')
+    request.session = SessionStore(session_key)
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': '3'}
+    assert storage['step2'].data == {'b': '2'}
+    assert storage._version == 3
+
+    # unless conflicts are to be raised
+    storage.on_conflict = 'raise'
+    storage['step1'].data = {'a': '4'}
+    stored = SessionStore(session_key)
+    del stored[storage.key]  # another request finished the wizard
+    stored.save()
+    with Assert.raises(StateConflict):
+        storage.process_response(HttpResponse(''))
+
+
 cookie = Tests()
 
 
@@ -255,10 +1137,379 @@ def should_completely_remove_data_from_cookies_when_deleted():
     assert 'namespace|name' not in response.cookies
 
 
+@cookie.test
+def shouldnt_set_cookie_when_state_unchanged():
+    storage = CookieStorage('name', 'namespace')
+    request, response = factory.get('/'), HttpResponse('')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(response)
+    assert storage.key in response.cookies
+
+    request, response = factory.get('/'), HttpResponse('')
+    request.COOKIES[storage.key] = storage.encode()
+    storage = CookieStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.current_step = None
+    storage.process_response(response)
+    assert storage.key not in response.cookies
+
+
+@cookie.test
+def should_cache_decoded_states():
+    class CachingCookieStorage(CookieStorage):
+        decoded_states = LRUCache(max_entries=10)
+
+    storage = CachingCookieStorage('name', 'namespace')
+    storage['step1'].data = {'a': ['1', '2']}
+    encoded = storage.encode()
+    cache = CachingCookieStorage.decoded_states
+    for i in range(3):
+        restored = CachingCookieStorage('name', 'namespace')
+        restored.decode(encoded)
+        assert restored['step1'].data.getlist('a') == ['1', '2']
+    assert (cache.hits, cache.misses) == (2, 1)
+
+    # the cached state is immutable, but steps are still modifiable
+    state = cache.get((storage.key, storage.hmac_digest, settings.SECRET_KEY,
+                       encoded))
+    with Assert.raises(TypeError):
+        state['steps']['step2'] = {}
+    restored['step1'].data = {'a': '3'}
+    assert restored.modified
+
+    # tampered cookies are never cached
+    with Assert.raises(SuspiciousOperation):
+        CachingCookieStorage('name', 'namespace').decode(encoded + ' ')
+    assert len(cache) == 1
+
+    # states are charged the memory they take up, not the cookie's length
+    class CompressingStorage(CachingCookieStorage):
+        compress_threshold = 100
+
+    storage = CompressingStorage('name', 'namespace')
+    storage['step1'].data = dict(('field%d' % i, 'x' * 100)
+                                 for i in range(100))
+    encoded = storage.encode()
+    CompressingStorage('name', 'namespace').decode(encoded)
+    size = cache.stats()['size']
+    assert size > 10000 > len(encoded)
+
+
+@cookie.test
+def should_sign_with_configured_digest():
+    class SHA256CookieStorage(CookieStorage):
+        hmac_digest = 'sha256'
+
+    storage = SHA256CookieStorage('name', 'namespace')
+    storage['step1'].data = {'a': 'b'}
+    encoded = storage.encode()
+    assert len(encoded.partition('$')[0]) == 64
+    restored = SHA256CookieStorage('name', 'namespace')
+    restored.decode(encoded)
+    assert restored['step1'].data['a'] == 'b'
+    with Assert.raises(SuspiciousOperation):
+        CookieStorage('name', 'namespace').decode(encoded)
+
+
+@cookie.test
+def should_accept_cookies_signed_with_fallback_secret_keys():
+    storage = CookieStorage('name', 'namespace')
+    storage['step1'].data = {'a': 'b'}
+    encoded = storage.encode()
+    with override_settings(SECRET_KEY='new secret'):
+        with Assert.raises(SuspiciousOperation):
+            CookieStorage('name', 'namespace').decode(encoded)
+    with override_settings(SECRET_KEY='new secret',
+                           SECRET_KEY_FALLBACKS=[settings.SECRET_KEY]):
+        restored = CookieStorage('name', 'namespace')
+        restored.decode(encoded)
+        assert restored['step1'].data['a'] == 'b'
+        # new cookies are signed with the new key
+        assert restored.encode() != encoded
+
+
+@cookie.test
+def should_reject_expired_cookies():
+    class ExpiringCookieStorage(CookieStorage):
+        max_age = 60
+
+    storage = ExpiringCookieStorage('name', 'namespace')
+    storage['step1'].data = {'a': 'b'}
+    encoded = storage.encode()
+    restored = ExpiringCookieStorage('name', 'namespace')
+    restored.decode(encoded)
+    assert restored['step1'].data['a'] == 'b'
+
+    payload = '{"current_step":null,"steps":{"step1":{"files":null,"data":null}}}'
+    expired = 't%s$%s' % (int_to_base36(int(time.time()) - 61), payload)
+    restored = ExpiringCookieStorage('name', 'namespace')
+    restored.decode('%s$%s' % (restored.hmac(expired), expired))
+    assert 'step1' not in restored
+
+    # cookies without timestamp are treated as expired
+    restored = ExpiringCookieStorage('name', 'namespace')
+    restored.decode(CookieStorage('name', 'namespace').sign(payload))
+    assert 'step1' not in restored
+
+    # the timestamp is signed
+    forged = encoded.replace('$t', '$tz', 1)
+    with Assert.raises(SuspiciousOperation):
+        ExpiringCookieStorage('name', 'namespace').decode(forged)
+
+
+@cookie.test
+def should_split_large_states_across_cookies():
+    class SmallCookieStorage(CookieStorage):
+        max_cookie_size = 200
+
+    storage = SmallCookieStorage('name', 'namespace')
+    request, response = factory.get('/'), HttpResponse('')
+    storage.process_request(request)
+    storage['step1'].data = {'text': '"quoted" ' * 50}
+    storage.process_response(response)
+    assert response.cookies[storage.key].value.startswith('chunks-')
+    chunks = [name for name in response.cookies if name != storage.key]
+    assert len(chunks) > 1
+    for name in chunks:
+        assert len(response.cookies[name].OutputString()) <= 200 + 10
+
+    # the chunks are reassembled
+    request = factory.get('/')
+    request.COOKIES.update((k, v.value) for k, v in response.cookies.items())
+    restored = SmallCookieStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step1'].data['text'] == '"quoted" ' * 50
+
+    # stale chunks are deleted once the state shrinks
+    restored['step1'].data = {'text': 'short'}
+    response = HttpResponse('')
+    restored.process_response(response)
+    assert not response.cookies[storage.key].value.startswith('chunks-')
+    for name in chunks:
+        assert response.cookies[name]['max-age'] == 0
+
+    # a chunk that was dropped by the browser empties the state, as do too
+    # many chunks
+    chunk = request.COOKIES.pop(chunks[-1])
+    storage = SmallCookieStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage.steps == {}
+
+    manifest = request.COOKIES[storage.key]
+    request.COOKIES[storage.key] = 'chunks-1000000'
+    storage = SmallCookieStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage.steps == {}
+
+    # a manipulated chunk fails verification
+    request.COOKIES[storage.key] = manifest
+    request.COOKIES[chunks[-1]] = chunk[:-1]
+    with Assert.raises(SuspiciousOperation):
+        SmallCookieStorage('name', 'namespace').process_request(request)
+
+
+@cookie.test
+def should_overflow_large_states_to_cache():
+    class OverflowStorage(CookieStorage):
+        overflow_threshold = 200
+
+    storage = OverflowStorage('name', 'namespace')
+    request, response = factory.get('/'), HttpResponse('')
+    storage.process_request(request)
+    storage['step1'].data = {'text': 'x' * 300}
+    storage.process_response(response)
+    pointer = response.cookies[storage.key].value
+    assert len(pointer) < 200
+    assert pointer.partition('$')[2].startswith('@')
+
+    request = factory.get('/')
+    request.COOKIES[storage.key] = pointer
+    restored = OverflowStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step1'].data['text'] == 'x' * 300
+
+    # writing again moves on to the next version, outdated pointers are
+    # rejected
+    restored['step1'].data = {'text': 'y' * 300}
+    response = HttpResponse('')
+    restored.process_response(response)
+    assert response.cookies[storage.key].value != pointer
+    outdated = OverflowStorage('name', 'namespace')
+    outdated.process_request(request)
+    assert outdated.steps == {}
+
+    # small states go back into the cookie
+    request.COOKIES[storage.key] = response.cookies[storage.key].value
+    restored = OverflowStorage('name', 'namespace')
+    restored.process_request(request)
+    restored['step1'].data = {'text': 'short'}
+    response = HttpResponse('')
+    restored.process_response(response)
+    assert response.cookies[storage.key].value == restored.encode()
+
+    # pointers are signed
+    request.COOKIES[storage.key] = '0123$@%s' % pointer.partition('@')[2]
+    with Assert.raises(SuspiciousOperation):
+        OverflowStorage('name', 'namespace').process_request(request)
+
+    # entries outlive the cache's default timeout, and are deleted once the
+    # wizard is reset
+    restored['step1'].data = {'text': 'z' * 300}
+    response = HttpResponse('')
+    restored.process_response(response)
+    request.COOKIES[storage.key] = response.cookies[storage.key].value
+    key = restored._overflow_key(restored._overflow_token)
+    real_time = time.time
+    time.time = lambda: real_time() + 301
+    try:
+        assert get_cache('default').get(key) is not None
+    finally:
+        time.time = real_time
+    restored = OverflowStorage('name', 'namespace')
+    restored.process_request(request)
+    restored.reset()
+    restored.process_response(HttpResponse(''))
+    assert get_cache('default').get(key) is None
+
+
+@cookie.test
+def cookies_for_the_root_path_should_be_replaced():
+    storage = CookieStorage('name', 'namespace')
+    storage.process_request(factory.get('/'))
+    storage['step1'].data = {'a': 'old'}
+    old = storage.encode()
+    storage['step1'].data = {'a': 'new'}
+    new = storage.encode()
+
+    # browsers send the cookie of the more specific path first
+    quote = lambda value: SimpleCookie().value_encode(value)[1]
+    header = '%s=%s; %s=%s' % (storage.key, quote(new), storage.key, quote(old))
+    request = factory.get('/wizard/', HTTP_COOKIE=header)
+    storage = CookieStorage('name', 'namespace')
+    storage.cookie_path = '/wizard/'
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': 'new'}
+
+    storage['step1'].data = {'a': 'newer'}
+    response = HttpResponse('')
+    storage.process_response(response)
+    assert response.cookies[storage.key]['path'] == '/wizard/'
+    cookies = [cookie for cookie in response.cookies.values()
+               if cookie.key == storage.key]
+    paths = sorted((cookie['path'], cookie['max-age']) for cookie in cookies)
+    assert paths == [('/', 0), ('/wizard/', '')]
+
+
+@cookie.test
+def per_step_cookies_should_only_be_set_for_modified_steps():
+    storage = PerStepCookieStorage('name', 'namespace')
+    request, response = factory.get('/'), HttpResponse('')
+    storage.process_request(request)
+    storage['step1'].data = {'a': '1'}
+    storage['step2'].data = {'b': '2'}
+    storage.process_response(response)
+    step1, step2 = storage._step_key('step1'), storage._step_key('step2')
+    assert set(response.cookies) == set([storage.key, step1, step2])
+
+    request = factory.get('/')
+    request.COOKIES.update((k, v.value) for k, v in response.cookies.items())
+    restored = PerStepCookieStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step1'].data['a'] == '1'
+    restored['step2'].data = {'b': '3'}
+    response = HttpResponse('')
+    restored.process_response(response)
+    assert set(response.cookies) == set([step2])
+
+    # removing a step deletes its cookie
+    request.COOKIES.update((k, v.value) for k, v in response.cookies.items())
+    restored = PerStepCookieStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step2'].data['b'] == '3'
+    del restored.steps['step1']
+    response = HttpResponse('')
+    restored.process_response(response)
+    assert response.cookies[step1]['max-age'] == 0
+    assert storage.key in response.cookies
+
+    # cookies can't be swapped between steps
+    request.COOKIES[step1] = request.COOKIES[step2]
+    with Assert.raises(SuspiciousOperation):
+        PerStepCookieStorage('name', 'namespace').process_request(request)
+
+
+@cookie.test
+def per_step_cookies_should_be_signed_again_before_they_expire():
+    class ExpiringStorage(PerStepCookieStorage):
+        max_age = 60
+
+    def respond(cookies, age=0, **data):
+        """
+        Writes *data* to the state in *cookies*, signing the cookies *age*
+        seconds in the past, and returns the names and values of the cookies
+        that were set.
+        """
+        request = factory.get('/')
+        request.COOKIES.update(cookies)
+        storage = ExpiringStorage('name', 'namespace')
+        storage.process_request(request)
+        for name, value in data.iteritems():
+            storage[name].data = value
+        response = HttpResponse('')
+        real_time = time.time
+        time.time = lambda: real_time() - age
+        try:
+            storage.process_response(response)
+        finally:
+            time.time = real_time
+        return dict((k, v.value) for k, v in response.cookies.items())
+
+    storage = ExpiringStorage('name', 'namespace')
+    step1, step2 = storage._step_key('step1'), storage._step_key('step2')
+    old = respond({}, age=40, step1={'a': '1'}, step2={'b': '2'})
+
+    # the cookies are more than half max_age old, so they're all signed again
+    written = respond(old, step2={'b': '3'})
+    assert set(written) == set([storage.key, step1, step2])
+    cookies = dict(old, **written)
+    written = respond(cookies, step2={'b': '4'})
+    assert set(written) == set([step2])
+    cookies.update(written)
+
+    request = factory.get('/')
+    request.COOKIES.update(cookies)
+    restored = ExpiringStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored['step1'].data == {'a': '1'}
+    assert restored['step2'].data == {'b': '4'}
+
+    # once a step has expired, so has the state
+    expired = respond({}, age=61, step1={'a': '1'}, step2={'b': '2'})
+    request.COOKIES[step1] = expired[step1]
+    restored = ExpiringStorage('name', 'namespace')
+    restored.process_request(request)
+    assert restored.steps == {}
+
+
 db = Tests()
 db.context(TestContext())
 
 
+@contextmanager
+def assert_num_queries(num):
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        yield
+    finally:
+        connection.use_debug_cursor = False
+    # savepoints depend on whether the test runs in a transaction
+    executed = [query for query in connection.queries[start:]
+                if 'SAVEPOINT' not in query['sql']]
+    assert len(executed) == num, executed
+
+
 @db.test
 def should_complain_if_no_session_and_has_anonymous_user():
     storage = DatabaseStorage('name', 'namespace')
@@ -300,6 +1551,7 @@ def should_create_new_model_instance_linked_to_user():
     request, response = factory.get('/'), HttpResponse('')
     request.user = User.objects.create_user('username', 'email@example.com')
     storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
     storage.process_response(response)
 
     assert WizardState.objects.count() == 1
@@ -314,11 +1566,367 @@ def should_create_new_model_instance_referencing_to_session():
     request = factory.get('/')
     request.session = SessionStore()
     storage.process_request(request)
+    # the row is created once the state is first written
+    assert WizardState.objects.count() == 0
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
     assert WizardState.objects.count() == 1
     assert WizardState.objects.get(name='name', namespace='namespace',
                                    session_key=request.session.session_key)
 
 
+@db.test
+def should_load_and_write_state_with_few_queries():
+    user = User.objects.create_user('username', 'email@example.com')
+    request = factory.get('/')
+    request.user = user
+
+    # a restart doesn't read the state, and doesn't create a row for it
+    storage = DatabaseStorage('name', 'namespace')
+    with assert_num_queries(1):  # UPDATE
+        storage.process_request(request)
+        storage.reset()
+        storage.process_response(HttpResponse(''))
+    assert WizardState.objects.count() == 0
+
+    storage = DatabaseStorage('name', 'namespace')
+    with assert_num_queries(2):  # SELECT, INSERT
+        storage.process_request(request)
+        storage['step1'].data = {'blarg': 'bloog'}
+        storage.process_response(HttpResponse(''))
+
+    storage = DatabaseStorage('name', 'namespace')
+    with assert_num_queries(2):  # SELECT, UPDATE
+        storage.process_request(request)
+        assert storage['step1'].data == {'blarg': 'bloog'}
+        storage['step1'].data = {'blarg': 'blorg'}
+        storage.process_response(HttpResponse(''))
+    state = WizardState.objects.get()
+    assert DatabaseStorage('name', 'namespace').deserialize(state.data)[
+        'steps']['step1']['data'] == {'blarg': 'blorg'}
+
+
+@db.test
+def should_merge_concurrent_database_writes():
+    user = User.objects.create_user('username', 'email@example.com')
+    request = factory.get('/')
+    request.user = user
+    storage = DatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'a': '1'}
+    storage.process_response(HttpResponse(''))
+
+    first = DatabaseStorage('name', 'namespace')
+    first.process_request(request)
+    first['step1']
+    second = DatabaseStorage('name', 'namespace')
+    second.process_request(request)
+    second['step1']
+    first['step2'].data = {'b': '2'}
+    first.process_response(HttpResponse(''))
+    second['step1'].data = {'a': '3'}
+    with assert_num_queries(3):  # UPDATE, SELECT, UPDATE
+        second.process_response(HttpResponse(''))
+
+    state = WizardState.objects.get()
+    assert state.version == 3
+    steps = DatabaseStorage('name', 'namespace').deserialize(state.data)[
+        'steps']
+    assert steps['step1']['data'] == {'a': '3'}
+    assert steps['step2']['data'] == {'b': '2'}
+
+    # a state that's created concurrently is merged too
+    WizardState.objects.all().delete()
+    first = DatabaseStorage('name', 'namespace')
+    first.process_request(request)
+    first['step1'].data = {'a': '1'}
+    second = DatabaseStorage('name', 'namespace')
+    second.process_request(request)
+    second['step2'].data = {'b': '2'}
+    first.process_response(HttpResponse(''))
+    second.process_response(HttpResponse(''))
+    state = WizardState.objects.get()
+    steps = DatabaseStorage('name', 'namespace').deserialize(state.data)[
+        'steps']
+    assert sorted(steps) == ['step1', 'step2']
+
+
+@db.test
+def should_raise_or_render_conflicts_if_configured():
+    class RaisingStorage(DatabaseStorage):
+        on_conflict = 'raise'
+
+    user = User.objects.create_user('username', 'email@example.com')
+    request = factory.get('/')
+    request.user = user
+    first = RaisingStorage('name', 'namespace')
+    first.process_request(request)
+    first['step1'].data = {'a': '1'}
+    second = RaisingStorage('name', 'namespace')
+    second.process_request(request)
+    second['step1'].data = {'a': '2'}
+    first.process_response(HttpResponse(''))
+    with Assert.raises(StateConflict):
+        second.process_response(HttpResponse(''))
+    state = WizardState.objects.get()
+    assert RaisingStorage('name', 'namespace').deserialize(state.data)[
+        'steps']['step1']['data'] == {'a': '1'}
+
+    class ConflictingStorage(RaisingStorage):
+        def process_response(self, response):
+            # another request writes the state in the meantime
+            WizardState.objects.update(version=F('version') + 1)
+            super(ConflictingStorage, self).process_response(response)
+
+    class Step1(forms.Form):
+        name = forms.CharField()
+
+    class ConflictingWizardView(WizardView):
+        # pylint: ignore=W0223
+        steps = (("Step 1", Step1), )
+        template_name = 'simple.html'
+
+        def get_storage(self):
+            return ConflictingStorage('name', 'namespace')
+
+    request = factory.post('/', {'wizard_next_step': 'Step 1'})
+    request.user = user
+    response = ConflictingWizardView.as_view()(request)
+    assert response.status_code == 409
+
+
+@db.test
+def per_step_database_storage_should_only_write_changed_steps():
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    for name in ('step1', 'step2', 'step3'):
+        storage[name].data = {'name': name}
+    storage.current_step = storage['step1']
+    storage.process_response(HttpResponse(''))
+    state = WizardState.objects.get()
+    index = storage.deserialize(state.data)
+    assert index == {'current_step': 'step1',
+                     'steps': ['step1', 'step2', 'step3'],
+                     'files': {'step1': None, 'step2': None, 'step3': None}}
+    assert WizardStepState.objects.filter(state=state).count() == 3
+
+    class CountingStorage(PerStepDatabaseStorage):
+        def deserialize(self, data):
+            deserialized.append(data)
+            return super(CountingStorage, self).deserialize(data)
+
+    deserialized = []
+    storage = CountingStorage('name', 'namespace')
+    # SELECT state, SELECT steps, UPDATE state, UPDATE step
+    with assert_num_queries(4):
+        storage.process_request(request)
+        assert storage['step1'].data == {'name': 'step1'}
+        storage['step2'].data = {'name': 'changed'}
+        storage.process_response(HttpResponse(''))
+    # only the steps that are accessed are deserialized (and the index)
+    assert len(deserialized) == 3
+    step = WizardStepState.objects.get(name='step2')
+    assert storage.deserialize(step.data)['data'] == {'name': 'changed'}
+
+    # a conflicting write that's refused doesn't write any steps
+    class RaisingStorage(PerStepDatabaseStorage):
+        on_conflict = 'raise'
+
+    first = RaisingStorage('name', 'namespace')
+    first.process_request(request)
+    second = RaisingStorage('name', 'namespace')
+    second.process_request(request)
+    second['step1']
+    first['step1'].data = {'name': 'kept'}
+    first.process_response(HttpResponse(''))
+    second['step1'].data = {'name': 'refused'}
+    second['step5'].data = {'name': 'refused'}
+    with Assert.raises(StateConflict):
+        second.process_response(HttpResponse(''))
+    step = WizardStepState.objects.get(name='step1')
+    assert storage.deserialize(step.data)['data'] == {'name': 'kept'}
+    assert not WizardStepState.objects.filter(name='step5').exists()
+
+    # removed steps are deleted, steps of concurrent writes are kept
+    first = PerStepDatabaseStorage('name', 'namespace')
+    first.process_request(request)
+    second = PerStepDatabaseStorage('name', 'namespace')
+    second.process_request(request)
+    del first.steps['step3']
+    first['step1'].data = {'name': 'first'}
+    first.process_response(HttpResponse(''))
+    second['step4'].data = {'name': 'second'}
+    second.process_response(HttpResponse(''))
+    state = WizardState.objects.get()
+    assert state.version == 5
+    assert storage.deserialize(state.data)['steps'] == ['step1', 'step2',
+                                                        'step4']
+    names = sorted(WizardStepState.objects.values_list('name', flat=True))
+    assert names == ['step1', 'step2', 'step4']
+
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'name': 'first'}
+    assert storage['step4'].data == {'name': 'second'}
+
+    # restarting replaces all steps, deleting removes all rows
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.reset()
+    storage['step1'].data = {'name': 'restarted'}
+    storage.process_response(HttpResponse(''))
+    names = list(WizardStepState.objects.values_list('name', flat=True))
+    assert names == ['step1']
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.delete()
+    assert WizardStepState.objects.count() == 0
+
+
+@db.test
+def per_step_database_storage_should_convert_whole_states():
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    storage = DatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'a': '1'}
+    storage['step2'].data = {'b': '2'}
+    storage.process_response(HttpResponse(''))
+
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': '1'}
+    storage['step1'].data = {'a': '3'}
+    storage.process_response(HttpResponse(''))
+    names = sorted(WizardStepState.objects.values_list('name', flat=True))
+    assert names == ['step1', 'step2']
+
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': '3'}
+    assert storage['step2'].data == {'b': '2'}
+
+    # states with steps that weren't accessed can be encoded
+    storage = PerStepDatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    assert storage['step1'].data == {'a': '3'}
+    steps = storage.deserialize(storage.encode())['steps']
+    assert steps['step1']['data'] == {'a': '3'}
+    assert steps['step2']['data'] == {'b': '2'}
+
+
+@db.test
+def should_read_states_through_cache():
+    class CachedStorage(DatabaseStorage):
+        state_cache = 'default'
+
+    class CachedPerStepStorage(PerStepDatabaseStorage):
+        state_cache = 'default'
+
+    get_cache('default').clear()
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    for storage_class in (CachedStorage, CachedPerStepStorage):
+        storage = storage_class('name', storage_class.__name__)
+        storage.process_request(request)
+        storage['step1'].data = {'a': '1'}
+        storage['step2'].data = {'b': '2'}
+        storage.process_response(HttpResponse(''))
+
+        storage = storage_class('name', storage_class.__name__)
+        with assert_num_queries(0):
+            storage.process_request(request)
+            assert storage['step1'].data == {'a': '1'}
+            assert storage['step2'].data == {'b': '2'}
+
+        # a stale entry is detected when the state is written
+        WizardState.objects.filter(namespace=storage_class.__name__).update(
+                version=F('version') + 1)
+        storage['step1'].data = {'a': '3'}
+        storage.process_response(HttpResponse(''))
+        storage = storage_class('name', storage_class.__name__)
+        with assert_num_queries(0):
+            storage.process_request(request)
+            assert storage['step1'].data == {'a': '3'}
+            assert storage._version == 3
+
+        storage.delete()
+        storage = storage_class('name', storage_class.__name__)
+        storage.process_request(request)
+        assert 'step1' not in storage
+
+
+@db.test
+def should_read_from_replica_unless_it_is_behind():
+    class ReplicaStorage(DatabaseStorage):
+        read_database = 'replica'
+
+    def replicate():
+        replica = WizardState.objects.using('replica')
+        replica.all().delete()
+        for state in WizardState.objects.all():
+            state.save(using='replica')
+            replica.filter(pk=state.pk).update(modified_at=state.modified_at)
+
+    request = factory.get('/')
+    SessionMiddleware().process_request(request)
+    try:
+        storage = ReplicaStorage('name', 'namespace')
+        storage.process_request(request)
+        storage['step1'].data = {'a': '1'}
+        storage.process_response(HttpResponse(''))
+        # the session must remain serializable as JSON
+        json.dumps(request.session[WRITTEN_AT_KEY])
+
+        # the replica doesn't have the row yet
+        storage = ReplicaStorage('name', 'namespace')
+        storage.process_request(request)
+        assert storage['step1'].data == {'a': '1'}
+
+        replicate()
+        storage = ReplicaStorage('name', 'namespace')
+        with assert_num_queries(0):  # on the default database
+            storage.process_request(request)
+            assert storage['step1'].data == {'a': '1'}
+        storage['step1'].data = {'a': '2'}
+        storage.process_response(HttpResponse(''))
+
+        # the replica is behind the last write
+        storage = ReplicaStorage('name', 'namespace')
+        storage.process_request(request)
+        assert storage['step1'].data == {'a': '2'}
+    finally:
+        WizardState.objects.using('replica').all().delete()
+
+
+@db.test
+def wizard_views_should_choose_databases():
+    class Step1(forms.Form):
+        name = forms.CharField()
+
+    class ReplicaWizardView(WizardView):
+        # pylint: ignore=W0223
+        steps = (("Step 1", Step1), )
+        template_name = 'simple.html'
+        storage = 'formwizard.storage.DatabaseStorage'
+        storage_read_database = 'replica'
+
+        def get_storage(self):
+            storage = super(ReplicaWizardView, self).get_storage()
+            storages.append(storage)
+            return storage
+
+    storages = []
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    response = ReplicaWizardView.as_view()(request)
+    assert response.status_code == 200
+    assert storages[0].database is None
+    assert storages[0].read_database == 'replica'
+
+
 @db.test
 def should_completely_remove_data_from_database_when_deleted():
     middleware = SessionMiddleware()
@@ -350,4 +1958,349 @@ def should_completely_remove_data_from_database_when_deleted():
     assert WizardState.objects.filter(name='name', namespace='namespace').count() == 0
     assert request.session['some other data'] == 'testing'
 
-tests = Tests((cookie, core, db, session))
+@db.test
+def should_release_files_of_deleted_states():
+    class DedupStorage(DatabaseStorage):
+        file_dedup = 'global'
+
+    class CleaningStorage(DatabaseStorage):
+        delete_orphaned_files = True
+
+    temp = tempfile.mkdtemp()
+    try:
+        file_storage = FileSystemStorage(location=temp)
+        request = factory.get('/')
+        request.user = User.objects.create_user('username',
+                                                'email@example.com')
+        for storage_class in (DedupStorage, CleaningStorage):
+            storage = storage_class('name', 'namespace', file_storage)
+            storage.process_request(request)
+            storage['step1'].files = {
+                    'a': SimpleUploadedFile('a.txt', b'content')}
+            storage.process_response(HttpResponse(''))
+
+            # the state is deleted without having been accessed
+            storage = storage_class('name', 'namespace', file_storage)
+            storage.process_request(request)
+            storage.delete()
+            assert WizardState.objects.count() == 0
+
+        assert WizardFile.objects.get().refcount == 0
+        assert file_storage.listdir('')[1] == [WizardFile.objects.get().key]
+    finally:
+        shutil.rmtree(temp)
+
+
+@db.test
+def shouldnt_save_model_instance_when_state_unchanged():
+    user = User.objects.create_user('username', 'email@example.com')
+    request, response = factory.get('/'), HttpResponse('')
+    request.user = user
+    storage = DatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(response)
+    modified_at = WizardState.objects.get().modified_at
+
+    WizardState.objects.update(modified_at=modified_at.replace(year=2000))
+    storage = DatabaseStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.process_response(response)
+    assert WizardState.objects.get().modified_at.year == 2000
+
+@db.test
+def should_store_identical_files_once_globally():
+    class DedupStorage(Storage):
+        file_dedup = 'global'
+
+    temp = tempfile.mkdtemp()
+    try:
+        file_storage = FileSystemStorage(location=temp)
+        first = DedupStorage('first', 'namespace', file_storage)
+        first['step1'].files = {'a': SimpleUploadedFile('a.txt', b'content')}
+        key = first.encode()['steps']['step1']['files']['a']['file_storage_key']
+        first.commit()
+        assert WizardFile.objects.get(key=key).refcount == 1
+
+        second = DedupStorage('second', 'namespace', file_storage)
+        second['step1'].files = {'b': SimpleUploadedFile('b.txt', b'content')}
+        encoded = second.encode()
+        assert encoded['steps']['step1']['files']['b']['file_storage_key'] == key
+        second.commit()
+        assert WizardFile.objects.get(key=key).refcount == 2
+        assert len(file_storage.listdir('')[1]) == 1
+
+        # encoding again without changes doesn't acquire another reference
+        restored = DedupStorage('second', 'namespace', file_storage)
+        restored.decode(encoded)
+        restored.encode()
+        restored.commit()
+        assert WizardFile.objects.get(key=key).refcount == 2
+
+        restored.reset()
+        restored.commit()
+        assert WizardFile.objects.get(key=key).refcount == 1
+    finally:
+        shutil.rmtree(temp)
+
+
+@db.test
+def should_clear_stale_tracked_files():
+    class TrackingStorage(Storage):
+        track_files = True
+
+    temp = tempfile.mkdtemp()
+    try:
+        file_storage = FileSystemStorage(location=temp)
+        storage = TrackingStorage('name', 'namespace', file_storage)
+        storage['step1'].files = {'a': SimpleUploadedFile('a.txt', b'a'),
+                                  'b': SimpleUploadedFile('b.txt', b'b')}
+        encoded = storage.encode()
+        storage.commit()
+        assert WizardFile.objects.count() == 2
+
+        # writing the state again marks its files as used
+        WizardFile.objects.update(modified_at=datetime(2000, 1, 1))
+        restored = TrackingStorage('name', 'namespace', file_storage)
+        restored.decode(encoded)
+        restored['step1'].files = {'a': restored['step1'].files['a']}
+        restored.encode()
+        restored.commit()
+
+        deleted = WizardFile.objects.clear_stale(file_storage,
+                                                 timedelta(days=1),
+                                                 batch_size=1)
+        assert deleted == 1
+        assert file_storage.listdir('')[1] == ['a.txt']
+        assert WizardFile.objects.get().key == 'a.txt'
+
+        # (the command uses a file storage of its own, ensure it has nothing
+        # to delete)
+        WizardFile.objects.update(key='nonexistent/a.txt')
+        # referenced files are deleted as well, as abandoned wizards that
+        # don't store their state in the database never release them
+        WizardFile.objects.create(key='nonexistent/b.txt', digest='b',
+                                  refcount=1)
+        WizardFile.objects.create(key='nonexistent/c.txt', digest='c',
+                                  refcount=1)
+        WizardFile.objects.exclude(key='nonexistent/c.txt') \
+                          .update(modified_at=datetime(2000, 1, 1))
+        call_command('clearwizardfiles', verbosity=0, file_storage=(
+                'django.core.files.storage.FileSystemStorage'))
+        keys = list(WizardFile.objects.values_list('key', flat=True))
+        assert keys == ['nonexistent/c.txt']
+    finally:
+        shutil.rmtree(temp)
+
+
+@db.test
+def should_clear_expired_and_orphaned_states():
+    temp = tempfile.mkdtemp()
+    try:
+        file_storage = FileSystemStorage(location=temp)
+        user = User.objects.create_user('username', 'email@example.com')
+        session = SessionStore()
+        session.save()
+        for name, scope in (('old', {'user': user}),
+                            ('current', {'session_key': session.session_key}),
+                            ('orphaned', {'session_key': 'missing'})):
+            storage = Storage(name, 'namespace', file_storage)
+            storage['step1'].files = {
+                    'a': SimpleUploadedFile('%s.txt' % name, b'content')}
+            data = storage.serialize(storage.encode())
+            WizardState.objects.create(name=name, namespace='namespace',
+                                       data=data, **scope)
+        WizardState.objects.filter(name='old').update(
+                modified_at=datetime(2000, 1, 1))
+
+        # a state that was written since it was found to be expired is kept
+        current = WizardState.objects.get(name='current').pk
+        deleted = WizardState.objects.delete_states(
+                [current], file_storage,
+                modified_before=datetime.now() - timedelta(days=1))
+        assert deleted == 0
+        assert WizardState.objects.filter(pk=current).exists()
+
+        deleted = WizardState.objects.clear_expired(timedelta(days=1),
+                                                    file_storage,
+                                                    batch_size=1)
+        assert deleted == 1
+        assert sorted(file_storage.listdir('')[1]) == ['current.txt',
+                                                       'orphaned.txt']
+
+        deleted = WizardState.objects.clear_orphaned(SessionStore().exists,
+                                                     file_storage)
+        assert deleted == 1
+        assert file_storage.listdir('')[1] == ['current.txt']
+        names = list(WizardState.objects.values_list('name', flat=True))
+        assert names == ['current']
+
+        WizardState.objects.update(modified_at=datetime(2000, 1, 1))
+        call_command('clearwizardstates', verbosity=0, orphaned=True,
+                     file_storage=(
+                         'django.core.files.storage.FileSystemStorage'))
+        assert WizardState.objects.count() == 0
+    finally:
+        shutil.rmtree(temp)
+
+
+@db.test
+def should_ignore_expired_states():
+    class ExpiringStorage(DatabaseStorage):
+        state_ttl = 60
+
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    storage = ExpiringStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+
+    storage = ExpiringStorage('name', 'namespace')
+    storage.process_request(request)
+    assert 'step1' in storage
+    WizardState.objects.update(modified_at=datetime(2000, 1, 1))
+    storage = ExpiringStorage('name', 'namespace')
+    storage.process_request(request)
+    assert 'step1' not in storage
+    storage['step2'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+    steps = storage.deserialize(WizardState.objects.get().data)['steps']
+    assert steps.keys() == ['step2']
+
+cache = Tests()
+cache.context(TestContext())
+
+
+@cache.test
+def should_store_state_in_cache():
+    user = User.objects.create_user('username', 'email@example.com')
+    for alias in ('default', 'files'):
+        class AliasCacheStorage(CacheStorage):
+            cache = alias
+
+        get_cache(alias).clear()
+        request = factory.get('/')
+        request.user = user
+        storage = AliasCacheStorage('name', 'namespace')
+        storage.process_request(request)
+        storage['step1'].data = {'blarg': 'bloog'}
+        storage.current_step = storage['step1']
+        storage.process_response(HttpResponse(''))
+        key = storage._key()
+        assert get_cache(alias).get(key) is not None
+
+        storage = AliasCacheStorage('name', 'namespace')
+        storage.process_request(request)
+        assert storage['step1'].data == {'blarg': 'bloog'}
+        assert storage.current_step.name == 'step1'
+
+        # states are scoped to the user or the session
+        other = factory.get('/')
+        SessionMiddleware().process_request(other)
+        storage = AliasCacheStorage('name', 'namespace')
+        storage.process_request(other)
+        assert 'step1' not in storage
+        storage['step1'].data = {'blarg': 'other'}
+        storage.process_response(HttpResponse(''))
+        assert other.session.session_key
+        assert storage._key() != key
+
+        storage = AliasCacheStorage('name', 'namespace')
+        storage.process_request(request)
+        storage.reset()
+        storage.process_response(HttpResponse(''))
+        assert get_cache(alias).get(key) is None
+
+        storage = AliasCacheStorage('name', 'namespace')
+        storage.process_request(other)
+        assert storage['step1'].data == {'blarg': 'other'}
+        storage.delete()
+        assert get_cache(alias).get(storage._key()) is None
+
+
+@cache.test
+def cache_storage_should_extend_lifetime_of_used_states():
+    request = factory.get('/')
+    request.user = User.objects.create_user('username', 'email@example.com')
+    storage = CacheStorage('name', 'namespace')
+    storage.process_request(request)
+    storage['step1'].data = {'blarg': 'bloog'}
+    storage.process_response(HttpResponse(''))
+    key = storage._key()
+    written_at, data = get_cache('default').get(key)
+
+    # recently written states aren't written again
+    storage = CacheStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.process_response(HttpResponse(''))
+    entry = get_cache('default').get(key)
+    assert entry[0] == written_at
+
+    get_cache('default').set(key, (written_at - CacheStorage.timeout, data))
+    storage = CacheStorage('name', 'namespace')
+    storage.process_request(request)
+    storage.process_response(HttpResponse(''))
+    entry = get_cache('default').get(key)
+    assert entry[0] > written_at - CacheStorage.timeout
+    assert entry[1] == data
+
+
+@cache.test
+def memory_storage_should_be_bounded_and_thread_safe():
+    class SmallMemoryStorage(MemoryStorage):
+        max_entries = 4
+        stripes = 1
+
+    memory = SmallMemoryStorage.get_cache()
+    memory.clear()
+    users = [User.objects.create_user('user%d' % i, 'email@example.com')
+             for i in range(8)]
+    errors = []
+
+    def fill(user):
+        request = factory.get('/')
+        request.user = user
+        try:
+            for i in range(20):
+                storage = SmallMemoryStorage('name', 'namespace')
+                storage.process_request(request)
+                storage['step%d' % i].data = {'user': user.username}
+                storage.current_step = storage['step%d' % i]
+                storage.process_response(HttpResponse(''))
+        except Exception as e:  # pylint: ignore=W0703
+            errors.append(e)
+
+    threads = [threading.Thread(target=fill, args=(user, ))
+               for user in users[:4]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for user in users[:4]:
+        request = factory.get('/')
+        request.user = user
+        storage = SmallMemoryStorage('name', 'namespace')
+        storage.process_request(request)
+        assert len(storage.steps) == 20
+        assert storage['step19'].data == {'user': user.username}
+
+    # the least recently used states are evicted
+    for user in users[4:]:
+        request = factory.get('/')
+        request.user = user
+        storage = SmallMemoryStorage('name', 'namespace')
+        storage.process_request(request)
+        storage['step1'].data = {'user': user.username}
+        storage.process_response(HttpResponse(''))
+    request.user = users[0]
+    storage = SmallMemoryStorage('name', 'namespace')
+    storage.process_request(request)
+    assert 'step1' not in storage
+    stats = memory.stats()
+    assert stats['entries'] == 4
+    assert stats['evictions'] == 4
+
+
+tests = Tests((cache, cookie, core, db, serializer, session))
@@ -200,6 +200,7 @@ class WizardTests(TestBase):
         # storage or session storage, either way invalidate both.
         self.client.cookies.pop('sessionid', None)
         self.client.cookies.pop('tests.app.views.wizard.CookieContactWizard|default', None)
+        self.client.cookies.pop(self.prefix.rstrip('-'), None)
 
         response = self.client.post(self.url, self.datas[3])
         assert response.status_code == 200
@@ -249,7 +250,18 @@ class CookieTests(WizardTests):
     prefix = 'tests.app.views.wizard.CookieContactWizard|default-'
 
 
-tests = Tests([SessionTests(), CookieTests()])
+class PerStepCookieTests(WizardTests):
+    url_name = 'wizard:perstepcookie'
+    prefix = 'tests.app.views.wizard.PerStepCookieContactWizard|default-'
+
+
+class CacheTests(WizardTests):
+    url_name = 'wizard:cache'
+    prefix = 'tests.app.views.wizard.CacheContactWizard|default-'
+
+
+tests = Tests([SessionTests(), CookieTests(), PerStepCookieTests(),
+               CacheTests()])
 
 
 @tests.test